@@ -0,0 +1,64 @@
+import time
+import argparse
+import torch
+from model import GPT, GPTConfig
+
+# (checkpoint_activations, checkpoint_every) settings compared by the report
+MODES = [("none", 1), ("mlp", 1), ("block", 2), ("block", 1)]
+
+def measure(config, B, T, device, steps=3):
+    """Runs forward/backward training steps and returns (peak activation bytes, seconds per step)."""
+    torch.manual_seed(1337)
+    model = GPT(config).to(device)
+    model.train()
+    x = torch.randint(config.vocab_size, (B, T), device=device)
+    y = torch.randint(config.vocab_size, (B, T), device=device)
+
+    saved = [0]
+    def pack(t):
+        saved[0] += t.numel() * t.element_size()
+        return t
+
+    times = []
+    for step in range(steps + 1):  # the first step is a warm-up
+        model.zero_grad(set_to_none=True)
+        if device == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+        saved[0] = 0
+        t0 = time.time()
+        with torch.autocast(device_type=device, dtype=torch.bfloat16):
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+                _, loss = model(x, y)
+        loss.backward()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        if step > 0:
+            times.append(time.time() - t0)
+    # on CUDA the allocator's peak is exact; elsewhere count the bytes autograd kept for backward
+    # (the inputs stashed by each checkpointed region are not included in that count)
+    peak = torch.cuda.max_memory_allocated() - base if device == "cuda" else saved[0]
+    return peak, sum(times) / len(times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="memory/speed trade-off of activation checkpointing")
+    parser.add_argument("-B", type=int, default=16, help="micro batch size")
+    parser.add_argument("-T", type=int, default=1024, help="sequence length")
+    parser.add_argument("--n_layer", type=int, default=12)
+    parser.add_argument("--n_head", type=int, default=12)
+    parser.add_argument("--n_embd", type=int, default=768)
+    parser.add_argument("--steps", type=int, default=3)
+    args = parser.parse_args()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    print(f"B={args.B} T={args.T} n_layer={args.n_layer} n_embd={args.n_embd} on {device}")
+    print(f"{'mode':<12} {'memory MiB':>11} {'mem %':>7} {'ms/step':>9} {'tok/s':>9} {'time %':>7}")
+    reference = None
+    for mode, every in MODES:
+        config = GPTConfig(block_size=args.T, vocab_size=50304, n_layer=args.n_layer, n_head=args.n_head, n_embd=args.n_embd,
+                           checkpoint_activations=mode, checkpoint_every=every)
+        peak, dt = measure(config, args.B, args.T, device, args.steps)
+        reference = reference or (peak, dt)
+        name = mode if every == 1 else f"{mode}/{every}"
+        print(f"{name:<12} {peak / 2**20:>11.1f} {100 * peak / reference[0]:>6.0f}% {dt * 1000:>9.1f} {args.B * args.T / dt:>9.0f} {100 * dt / reference[1]:>6.0f}%")
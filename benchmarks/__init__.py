@@ -0,0 +1,11 @@
+"""
+Repeatable micro-benchmarks for attention, generation, data loading and HellaSwag eval.
+
+Run from the repository root, e.g.
+
+    python -m benchmarks.run --size tiny --out bench.json
+    python -m benchmarks.run --size tiny --baseline bench.json
+
+Results are written as JSON, comparing against a baseline flags every metric that got
+worse by more than --tolerance and exits non-zero.
+"""
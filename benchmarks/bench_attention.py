@@ -0,0 +1,30 @@
+import torch
+from model import CausalSelfAttention, build_rope
+from .common import measure, result
+
+def run(config, device, B=4, seq_lens=(64, 128, 256), n_heads=(2, 4, 8), repeat=5):
+    """CausalSelfAttention forward and forward+backward time for every (T, n_head) pair."""
+    results = []
+    for n_head in n_heads:
+        if config.n_embd % n_head != 0:
+            continue
+        config_h = type(config)(**{**config.__dict__, "n_head": n_head})
+        torch.manual_seed(0)
+        attn = CausalSelfAttention(config_h).to(device)
+        for T in seq_lens:
+            if T > config.block_size:
+                continue
+            x = torch.randn(B, T, config.n_embd, device=device, requires_grad=True)
+            rope = build_rope(config.n_embd // n_head, T, device=device)
+            def forward():
+                with torch.no_grad():
+                    attn(x, rope)
+            def forward_backward():
+                attn(x, rope).sum().backward()
+            name = f"attention/T={T}/n_head={n_head}"
+            fwd = measure(forward, device, repeat=repeat)
+            fwd_bwd = measure(forward_backward, device, repeat=repeat)
+            results.append(result(f"{name}/forward_ms", fwd * 1000, "ms"))
+            results.append(result(f"{name}/forward_backward_ms", fwd_bwd * 1000, "ms"))
+            results.append(result(f"{name}/forward_tokens_per_sec", B * T / fwd, "tok/s", higher_is_better=True))
+    return results
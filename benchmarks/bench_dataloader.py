@@ -0,0 +1,48 @@
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+import numpy as np
+from dataloader import DataLoader
+from .common import result
+
+@contextmanager
+def synthetic_shards(num_shards, shard_tokens):
+    """A temporary working directory with an edu_fineweb10B/ of random uint16 shards, as DataLoader expects."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        data_root = os.path.join(tmp, "edu_fineweb10B")
+        os.makedirs(data_root)
+        rng = np.random.default_rng(0)
+        for i in range(num_shards):
+            split = "val" if i == 0 else "train"
+            np.save(os.path.join(data_root, f"edufineweb_{split}_{i:06d}.npy"), rng.integers(0, 50257, shard_tokens, dtype=np.uint16))
+        os.chdir(tmp)
+        try:
+            yield
+        finally:
+            os.chdir(cwd)
+
+def run(B=8, T=1024, num_batches=300, shard_tokens=2**19, prefetches=(0, 4)):
+    """next_batch throughput and the latency of the calls that cross into a new shard."""
+    results = []
+    with synthetic_shards(num_shards=4, shard_tokens=shard_tokens):
+        for prefetch in prefetches:
+            loader = DataLoader(B=B, T=T, split="train", prefetch=prefetch)
+            loader.next_batch()  # let the prefetch thread get going
+            times, switches = [], []
+            t_start = time.perf_counter()
+            for _ in range(num_batches):
+                shard = loader.current_shard
+                t0 = time.perf_counter()
+                loader.next_batch()
+                dt = time.perf_counter() - t0
+                (switches if loader.current_shard != shard else times).append(dt)
+            total = time.perf_counter() - t_start
+            loader._stop_prefetch()
+            name = f"dataloader/B={B}/T={T}/prefetch={prefetch}"
+            results.append(result(f"{name}/batches_per_sec", num_batches / total, "batch/s", higher_is_better=True))
+            results.append(result(f"{name}/next_batch_ms", 1000 * float(np.median(times)), "ms"))
+            if switches:
+                results.append(result(f"{name}/shard_switch_ms", 1000 * float(np.mean(switches)), "ms"))
+    return results
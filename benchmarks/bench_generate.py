@@ -0,0 +1,36 @@
+import torch
+from model import GPT
+from .common import measure, result
+
+def run(config, device, batch_size=1, prompt_len=32, new_tokens=64, repeat=3):
+    """
+    Prefill and decode throughput of the path GPT.generate takes: one forward of the whole
+    prompt into a fresh KV cache, then one single-token forward per new token.
+    """
+    torch.manual_seed(0)
+    model = GPT(config).to(device).eval()
+    max_len = min(prompt_len + new_tokens, config.block_size)
+    prompt = torch.randint(config.vocab_size, (batch_size, prompt_len), device=device)
+    token = prompt[:, -1:].contiguous()
+
+    def prefill():
+        with torch.no_grad():
+            model(prompt, kv_cache=model.init_kv_cache(batch_size, max_len), logit_positions=-1)
+
+    kv_cache = model.init_kv_cache(batch_size, max_len)
+    def decode():
+        with torch.no_grad():
+            for pos in range(prompt_len, max_len):
+                model(token, kv_cache=kv_cache, start_pos=pos)
+
+    with torch.no_grad():
+        model(prompt, kv_cache=kv_cache)
+    prefill_time = measure(prefill, device, repeat=repeat)
+    decode_time = measure(decode, device, repeat=repeat)
+    name = f"generate/B={batch_size}/prompt={prompt_len}"
+    decode_steps = max_len - prompt_len
+    return [
+        result(f"{name}/prefill_tokens_per_sec", batch_size * prompt_len / prefill_time, "tok/s", higher_is_better=True),
+        result(f"{name}/decode_tokens_per_sec", batch_size * decode_steps / decode_time, "tok/s", higher_is_better=True),
+        result(f"{name}/decode_ms_per_token", decode_time * 1000 / decode_steps, "ms"),
+    ]
@@ -0,0 +1,46 @@
+import os
+import time
+import torch
+from model import GPT
+from .common import result, synchronize
+
+def synthetic_examples(num_examples, vocab_size, seed=0):
+    # roughly HellaSwag-shaped: ~40 context tokens and 4 endings of ~20 tokens
+    g = torch.Generator().manual_seed(seed)
+    def tokens(n):
+        return torch.randint(vocab_size, (n,), generator=g).tolist()
+    examples = []
+    for _ in range(num_examples):
+        ctx = tokens(int(torch.randint(20, 60, (1,), generator=g)))
+        endings = [tokens(int(torch.randint(8, 32, (1,), generator=g))) for _ in range(4)]
+        examples.append((ctx, endings, int(torch.randint(4, (1,), generator=g))))
+    return examples
+
+def load_examples(num_examples, vocab_size):
+    """The first `num_examples` rendered val examples if their token cache exists, synthetic ones otherwise."""
+    cache = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "hellaswag", "hellaswag_val_tokens.pt")
+    if os.path.exists(cache):
+        return torch.load(cache)[:num_examples], "val"
+    return synthetic_examples(num_examples, vocab_size), "synthetic"
+
+def run(config, device, num_examples=64, batch_size=32):
+    """Wall-clock time of the batched HellaSwag scoring loop (GPT.score_continuations) on `num_examples` examples."""
+    torch.manual_seed(0)
+    model = GPT(config).to(device).eval()
+    examples, source = load_examples(num_examples, config.vocab_size)
+    def evaluate():
+        with torch.no_grad():
+            for i in range(0, len(examples), batch_size):
+                batch = examples[i:i+batch_size]
+                model.score_continuations([ctx for ctx, _, _ in batch], [endings for _, endings, _ in batch])
+    evaluate()  # warm-up
+    synchronize(device)
+    t0 = time.perf_counter()
+    evaluate()
+    synchronize(device)
+    dt = time.perf_counter() - t0
+    name = f"hellaswag/{source}/n={len(examples)}"
+    return [
+        result(f"{name}/eval_s", dt, "s"),
+        result(f"{name}/examples_per_sec", len(examples) / dt, "ex/s", higher_is_better=True),
+    ]
@@ -0,0 +1,72 @@
+import json
+import os
+import platform
+import statistics
+import time
+import torch
+from model import GPTConfig
+
+# small configs so everything runs on a CPU-only box, gpt2 is the 124M model train.py trains
+CONFIGS = {
+    "tiny": dict(block_size=256, vocab_size=50304, n_layer=2, n_head=4, n_embd=128),
+    "small": dict(block_size=512, vocab_size=50304, n_layer=6, n_head=6, n_embd=384),
+    "gpt2": dict(block_size=1024, vocab_size=50304, n_layer=12, n_head=12, n_embd=768),
+}
+
+def get_config(size, **overrides):
+    return GPTConfig(**{**CONFIGS[size], **overrides})
+
+def synchronize(device):
+    if str(device).startswith("cuda"):
+        torch.cuda.synchronize()
+
+def measure(fn, device, warmup=2, repeat=5):
+    """Median wall-clock seconds of fn() over `repeat` timed runs, after `warmup` untimed ones."""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+def result(name, value, unit, higher_is_better=False):
+    return {"name": name, "value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+def environment(device):
+    return {
+        "torch": torch.__version__,
+        "device": str(device),
+        "threads": torch.get_num_threads(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+    }
+
+def save_results(path, results, meta):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+    os.replace(tmp_path, path)
+
+def load_results(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Matches results to the baseline by name and returns (name, baseline, value, change, regressed)
+    rows, where change is the relative change in the "better" direction (negative is worse) and
+    regressed means it got worse by more than `tolerance`.
+    """
+    base = {r["name"]: r for r in baseline["results"]}
+    rows = []
+    for r in results:
+        if r["name"] not in base or base[r["name"]]["value"] == 0:
+            continue
+        old, new = base[r["name"]]["value"], r["value"]
+        change = (new - old) / old if r["higher_is_better"] else (old - new) / old
+        rows.append((r["name"], old, new, change, change < -tolerance))
+    return rows
@@ -0,0 +1,56 @@
+import argparse
+import sys
+import torch
+from . import bench_attention, bench_dataloader, bench_generate, bench_hellaswag
+from .common import CONFIGS, compare, environment, get_config, load_results, save_results
+
+BENCHMARKS = ("attention", "generate", "dataloader", "hellaswag")
+
+def int_list(s):
+    return tuple(int(v) for v in s.split(","))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ArcaneGPT micro-benchmarks")
+    parser.add_argument("--size", type=str, default="tiny", choices=sorted(CONFIGS), help="GPTConfig preset")
+    parser.add_argument("--only", type=str, default=",".join(BENCHMARKS), help="comma separated subset of " + ",".join(BENCHMARKS))
+    parser.add_argument("-d", "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seq_lens", type=int_list, default=(64, 128, 256), help="attention sequence lengths")
+    parser.add_argument("--n_heads", type=int_list, default=(2, 4, 8), help="attention head counts")
+    parser.add_argument("--repeat", type=int, default=5, help="timed repetitions, the median is reported")
+    parser.add_argument("-o", "--out", type=str, default=None, help="write the results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative slowdown that counts as a regression")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config = get_config(args.size)
+    only = args.only.split(",")
+    assert all(b in BENCHMARKS for b in only), f"unknown benchmark in {args.only}"
+    results = []
+    if "attention" in only:
+        results += bench_attention.run(config, args.device, seq_lens=args.seq_lens, n_heads=args.n_heads, repeat=args.repeat)
+    if "generate" in only:
+        results += bench_generate.run(config, args.device, repeat=args.repeat)
+    if "dataloader" in only:
+        results += bench_dataloader.run()
+    if "hellaswag" in only:
+        results += bench_hellaswag.run(config, args.device)
+
+    for r in results:
+        print(f"{r['name']:<60} {r['value']:>12.3f} {r['unit']}")
+    meta = {"size": args.size, "config": CONFIGS[args.size], "environment": environment(args.device)}
+    if args.out:
+        save_results(args.out, results, meta)
+        print(f"wrote {args.out}")
+
+    if args.baseline:
+        baseline = load_results(args.baseline)
+        if baseline["meta"]["environment"] != meta["environment"] or baseline["meta"]["size"] != args.size:
+            print("warning: the baseline was recorded with a different setup, differences may not be regressions")
+        rows = compare(results, baseline, args.tolerance)
+        print(f"\n{'benchmark':<60} {'baseline':>12} {'now':>12} {'change':>8}")
+        for name, old, new, change, regressed in rows:
+            print(f"{name:<60} {old:>12.3f} {new:>12.3f} {change*100:>+7.1f}%{'  REGRESSION' if regressed else ''}")
+        regressions = sum(regressed for *_, regressed in rows)
+        print(f"{regressions} regression(s) beyond {args.tolerance*100:.0f}% out of {len(rows)} compared")
+        sys.exit(1 if regressions else 0)
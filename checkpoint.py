@@ -0,0 +1,180 @@
+import os
+import re
+import threading
+import time
+import torch
+import torch.distributed as dist
+
+class CheckpointManager:
+    """
+    Asynchronous, atomic checkpoint writer.
+
+    `save` only takes an in-memory snapshot of the state on the training thread (tensors
+    are copied into host buffers, pinned for CUDA and reused between saves, with one sync
+    at the end), then a background thread serializes it to a temporary file, fsyncs it
+    and renames it into place, so a crash mid-write never touches the last good checkpoint.
+
+    Only the elected writer (rank 0 under DDP) writes the checkpoint, every rank may call
+    `save`. State that is sharded across ranks (ZeRO optimizer state) goes to one extra
+    file per rank and step, written by that rank. The latest checkpoint is only replaced
+    once every rank's shard of its step is on disk, and older shard sets are only deleted
+    once it has been, so there is always a complete checkpoint to resume from. Numbered
+    model checkpoints are pruned to the newest `keep_last`, except those at a multiple of
+    `keep_every` steps which are kept for good.
+    """
+    def __init__(self, log_dir, is_writer=True, rank=0, keep_last=None, keep_every=None, latest_name="latest_checkpoint.pt"):
+        self.log_dir = log_dir
+        self.is_writer = is_writer
+        self.rank = rank
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.latest_path = os.path.join(log_dir, latest_name)
+        self.snapshot_time = 0.0  # seconds the last save blocked the caller
+        self._buffers = []  # pinned host copies reused between snapshots, in traversal order
+        self._thread = None
+        self._error = None
+        # the writer threads of all ranks agree on sharded saves over their own group, apart from training's collectives
+        self._group = dist.new_group(backend="gloo") if dist.is_available() and dist.is_initialized() else None
+
+    def numbered_path(self, step):
+        return os.path.join(self.log_dir, f"arcane_{step}.pt")
+
+    def shard_path(self, rank, step):
+        return self.latest_path[:-len(".pt")] + f"_{step}_shard{rank}.pt"
+
+    def load_latest(self, map_location=None):
+        if not os.path.exists(self.latest_path):
+            return None
+        return torch.load(self.latest_path, map_location=map_location)
+
+    def load_shard(self, step, map_location=None):
+        """Loads this rank's shard written with the checkpoint of `step`."""
+        path = self.shard_path(self.rank, step)
+        assert os.path.exists(path), f"no sharded state of step {step} for rank {self.rank}, was the checkpoint saved with another world size?"
+        shard = torch.load(path, map_location=map_location)
+        assert shard['step'] == step, f"rank {self.rank} shard is from step {shard['step']}, the checkpoint from step {step}"
+        return shard['state']
+
+    def _snapshot(self, obj, index, memo):
+        # copies every tensor in a nested dict/list structure to the host, reusing the buffers of the previous snapshot
+        if torch.is_tensor(obj):
+            key = (obj.device, obj.data_ptr(), obj.shape, obj.stride(), obj.dtype)
+            if key in memo:
+                return memo[key], index  # tied weights stay a single tensor
+            if index == len(self._buffers) or self._buffers[index].shape != obj.shape or self._buffers[index].dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.device.type == "cuda")
+                self._buffers[index:index + 1] = [buf]
+            memo[key] = self._buffers[index].copy_(obj.detach(), non_blocking=True)
+            return memo[key], index + 1
+        if isinstance(obj, dict):
+            out = {}
+            for key, value in obj.items():
+                out[key], index = self._snapshot(value, index, memo)
+            return out, index
+        if isinstance(obj, (list, tuple)):
+            out = []
+            for value in obj:
+                value, index = self._snapshot(value, index, memo)
+                out.append(value)
+            return type(obj)(out), index
+        return obj, index
+
+    @staticmethod
+    def _atomic_save(obj, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            torch.save(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        # make the rename itself durable
+        dir_fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _prune(self):
+        if self.keep_last is None:
+            return
+        steps = sorted(int(m.group(1)) for m in (re.fullmatch(r"arcane_(\d+)\.pt", f) for f in os.listdir(self.log_dir)) if m)
+        for step in steps[:-self.keep_last] if self.keep_last > 0 else steps:
+            if self.keep_every is None or step % self.keep_every != 0:
+                os.remove(self.numbered_path(step))
+
+    def _all_ok(self, ok):
+        # True when `ok` holds on every rank, doubles as a barrier between the writer threads
+        if self._group is None:
+            return ok
+        flag = torch.tensor([int(ok)])
+        dist.all_reduce(flag, op=dist.ReduceOp.MIN, group=self._group)
+        return bool(flag.item())
+
+    def _prune_shards(self, step):
+        # this rank's shards of every other step, the latest checkpoint no longer refers to them
+        pattern = re.escape(os.path.basename(self.latest_path)[:-len(".pt")]) + rf"_(\d+)_shard{self.rank}\.pt"
+        for m in (re.fullmatch(pattern, f) for f in os.listdir(self.log_dir)):
+            if m and int(m.group(1)) != step:
+                os.remove(os.path.join(self.log_dir, m.group(0)))
+
+    def _write_state(self, state, step, numbered):
+        self._atomic_save(state, self.latest_path)
+        if numbered:
+            self._atomic_save({'model': state['model']}, self.numbered_path(step))
+            self._prune()
+
+    def _write(self, state, shard, step, numbered):
+        if shard is None:
+            try:
+                self._write_state(state, step, numbered)
+            except BaseException as e:
+                self._error = e
+            return
+        # sharded save: every rank writes its shard of this step, the latest checkpoint is only replaced
+        # once all of them are on disk, and the previous shard sets are only deleted once it has been
+        ok = True
+        try:
+            self._atomic_save({'step': step, 'state': shard}, self.shard_path(self.rank, step))
+        except BaseException as e:
+            self._error, ok = e, False
+        if not self._all_ok(ok):
+            return
+        try:
+            if state is not None:
+                self._write_state(state, step, numbered)
+        except BaseException as e:
+            self._error, ok = e, False
+        if not self._all_ok(ok):
+            return
+        try:
+            self._prune_shards(step)
+        except BaseException as e:
+            self._error = e
+
+    def wait(self):
+        """Blocks until the checkpoint being written (if any) is on disk, re-raising a failed write."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, state, step, numbered=False, shard=None):
+        """
+        Snapshots `state` (a nested dict holding e.g. model and optimizer state dicts) and
+        writes it to the latest checkpoint in the background, plus a numbered model-only
+        checkpoint if `numbered`. `shard` is this rank's part of any sharded state, saved by
+        every rank. Returns as soon as the snapshot is taken.
+        """
+        if not self.is_writer and shard is None:
+            return
+        t0 = time.time()
+        self.wait()  # the previous write still reads the host buffers
+        snapshot, index = self._snapshot(state, 0, {}) if self.is_writer else (None, 0)
+        shard_snapshot, _ = self._snapshot(shard, index, {})
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # the host copies above are asynchronous
+        self._thread = threading.Thread(target=self._write, args=(snapshot, shard_snapshot, step, numbered), daemon=False)
+        self._thread.start()
+        self.snapshot_time = time.time() - t0
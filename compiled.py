@@ -0,0 +1,93 @@
+import torch
+from torch.nn import functional as F
+
+def bucket_length(n, max_len, min_bucket=16):
+    """Smallest power of two >= n (and >= min_bucket), capped at max_len."""
+    bucket = min_bucket
+    while bucket < n:
+        bucket *= 2
+    return min(bucket, max_len)
+
+class CompiledGPT:
+    """
+    Opt-in torch.compile'd entry points for a GPT: training/eval forward, prompt prefill
+    and single-token decode.
+
+    Compiled graphs are specialized to their input shapes, so every path keeps them fixed:
+    training and eval batches are (B, T) already, prompts are right-padded to a power-of-two
+    bucket before prefill, and decoding runs on a static KV cache (see KVCache) with per-row
+    tensor offsets. The static cache always has the same length, `max_len` (the block size
+    unless warmup sets it), whatever length a generate call stops at, so its graphs never
+    change either. Each bucket compiles once, `warmup` does that ahead of time. Works on
+    CPU as well as CUDA, inductor only needs a C++ compiler there.
+    """
+    def __init__(self, model, mode=None, min_bucket=16, max_len=None):
+        self.model = model
+        self.min_bucket = min_bucket
+        self.max_len = min(max_len or model.config.block_size, model.config.block_size)
+        # one graph per prompt bucket plus train and eval, more than dynamo keeps per function by default
+        torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, 32)
+        self.forward = torch.compile(model, mode=mode, dynamic=False)
+        self.step = torch.compile(self._step, mode=mode, dynamic=False)
+
+    def __call__(self, idx, targets=None):
+        return self.forward(idx, targets)
+
+    def _step(self, idx, kv_cache, start_pos):
+        logits, _ = self.model(idx, kv_cache=kv_cache, start_pos=start_pos)
+        return logits
+
+    def init_kv_cache(self, batch_size):
+        return self.model.init_kv_cache(batch_size, self.max_len, static=True)
+
+    def prefill(self, idx, kv_cache, start_pos=0):
+        """Runs a prompt into the cache and returns the logits of its last position, (B, 1, vocab_size)."""
+        T = idx.size(1)
+        if start_pos != 0:
+            # after a prefix cache hit the mask shape depends on the prefix length, keep that in eager mode
+            logits, _ = self.model(idx, kv_cache=kv_cache, start_pos=start_pos, logit_positions=-1)
+            return logits
+        # the padding writes junk keys/values past the prompt, but every decode step
+        # overwrites its own position before attending to it and masks everything after
+        bucket = bucket_length(T, kv_cache.max_len, self.min_bucket)
+        # the last prompt position is passed as a tensor, so one graph serves every prompt length in the bucket
+        last = torch.full((idx.size(0),), T - 1, dtype=torch.long, device=idx.device)
+        logits, _ = self.forward(F.pad(idx, (0, bucket - T)), kv_cache=kv_cache, logit_positions=last)
+        return logits
+
+    def decode(self, idx, kv_cache, start_pos):
+        """Forwards one token per row, `start_pos` is an int or a (B,) tensor of per-row positions."""
+        if not torch.is_tensor(start_pos):
+            start_pos = torch.full((idx.size(0),), start_pos, dtype=torch.long, device=idx.device)
+        # graphs are specialized to strides too, a (B, 1) column sliced out of a longer tensor keeps the longer row stride
+        return self.step(idx.reshape(-1)[:, None], kv_cache, start_pos)
+
+    def warmup(self, batch_size=1, max_len=None, train_shape=None):
+        """
+        Compiles ahead of time: every prefill bucket up to `max_len` and the decode step for
+        `batch_size` rows, plus a forward/backward of a `train_shape` (B, T) batch if given.
+        A `max_len` becomes the static cache length of all later decoding.
+        """
+        if max_len is not None:
+            self.max_len = min(max_len, self.model.config.block_size)
+        model = self.model
+        device = model.transformer.wpe.weight.device
+        was_training = model.training
+        if train_shape is not None:
+            model.train()
+            x = torch.zeros(train_shape, dtype=torch.long, device=device)
+            _, loss = self.forward(x, x)
+            loss.backward()
+            model.zero_grad(set_to_none=True)
+
+        model.eval()
+        with torch.no_grad():
+            kv_cache = self.init_kv_cache(batch_size)
+            bucket = self.min_bucket
+            while True:
+                self.prefill(torch.zeros((batch_size, min(bucket, kv_cache.max_len)), dtype=torch.long, device=device), kv_cache)
+                if bucket >= kv_cache.max_len:
+                    break
+                bucket *= 2
+            self.decode(torch.zeros((batch_size, 1), dtype=torch.long, device=device), kv_cache, 0)
+        model.train(was_training)
@@ -0,0 +1,47 @@
+import os
+from dataclasses import asdict, replace
+import torch
+from model import GPT, GPTConfig
+
+def mean_pool_kv(weight, n_head, n_kv_head):
+    """Averages the rows of the K or V projection (n_head * head_dim, ...) over groups of n_head // n_kv_head heads."""
+    group = n_head // n_kv_head
+    head_dim = weight.size(0) // n_head
+    return weight.view(n_kv_head, group, head_dim, *weight.shape[1:]).mean(dim=1).reshape(n_kv_head * head_dim, *weight.shape[1:])
+
+def mha_to_gqa(state_dict, config, n_kv_head):
+    """
+    Converts the state dict of a multi-head GPT into the grouped-query layout with `n_kv_head`
+    key/value heads: each group of consecutive heads shares the mean of their key and value
+    projections (as in the GQA paper's uptraining recipe). Returns (state_dict, config).
+    """
+    src_kv_head = config.n_kv_head or config.n_head
+    assert src_kv_head == config.n_head, "the checkpoint already uses grouped-query attention"
+    assert config.n_head % n_kv_head == 0, "n_head must be a multiple of n_kv_head"
+    C = config.n_embd
+    state_dict = dict(state_dict)
+    for key in [k for k in state_dict if k.endswith("attn.c_attn.weight") or k.endswith("attn.c_attn.bias")]:
+        q, k, v = state_dict[key].split(C, dim=0)
+        k, v = mean_pool_kv(k, config.n_head, n_kv_head), mean_pool_kv(v, config.n_head, n_kv_head)
+        state_dict[key] = torch.cat((q, k, v), dim=0)
+    return state_dict, replace(config, n_kv_head=n_kv_head)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="mean-pool the key/value heads of a multi-head checkpoint for grouped-query uptraining")
+    parser.add_argument("-c", "--checkpoint", type=str, default=os.path.join("log", "latest_checkpoint.pt"), help="multi-head checkpoint")
+    parser.add_argument("-o", "--out", type=str, default=None, help="where to write the converted checkpoint")
+    parser.add_argument("-k", "--n_kv_head", type=int, required=True, help="key/value heads of the converted model, 1 for multi-query")
+    args = parser.parse_args()
+
+    config = GPTConfig(vocab_size=50304)
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    state_dict, config = mha_to_gqa(checkpoint['model'], config, args.n_kv_head)
+    model = GPT(config)
+    model.load_state_dict(state_dict)  # makes sure the converted layout matches the model
+    kv_fraction = config.n_kv_head / config.n_head
+    print(f"{config.n_head} query heads share {config.n_kv_head} key/value heads, the KV cache shrinks to {kv_fraction:.0%} of its size")
+
+    out = args.out or os.path.join("log", f"arcane_gqa{args.n_kv_head}.pt")
+    torch.save({'model': model.state_dict(), 'config': asdict(config)}, out)
+    print(f"wrote {out}, set n_kv_head = {args.n_kv_head} and init_from = {out!r} in train.py to uptrain it")
@@ -1,51 +1,215 @@
 import numpy as np
 import os
+import queue
+import threading
+import time
 import torch
 
 def load_tokens(filename):
-    npt = np.load(filename)
-    npt = npt.astype(np.int32)
-    ptt = torch.tensor(npt, dtype=torch.long)
-    return ptt
+    # memory-map the uint16 shard read-only, nothing is read or copied until a batch slices it
+    return np.load(filename, mmap_mode='r')
+
+# Document index sidecar: the uint32 offsets of every <|endoftext|> token (i.e. every document start) in a shard
+DOC_INDEX_SUFFIX = "_docs.npy"
+
+def doc_index_filename(shard_filename):
+    return shard_filename[:-len(".npy")] + DOC_INDEX_SUFFIX if shard_filename.endswith(".npy") else shard_filename + DOC_INDEX_SUFFIX
+
+def build_doc_index(tokens, eot):
+    return np.flatnonzero(np.asarray(tokens) == eot).astype(np.uint32)
+
+def load_doc_index(shard_filename):
+    filename = doc_index_filename(shard_filename)
+    assert os.path.exists(filename), f"no document index for {shard_filename}, run `python fineweb.py --backfill_index`"
+    return np.load(filename, mmap_mode='r')
 
 class DataLoader:
-    def __init__(self, B, T, split):
+    def __init__(self, B, T, split, process_rank=0, num_processes=1, shuffle=False, seed=0, prefetch=0, pin_memory=False):
         self.B = B
         self.T = T
+        self.process_rank = process_rank
+        self.num_processes = num_processes
         assert split in {'train', 'val'}
         
         # get the shard filenames
         data_root = "edu_fineweb10B"
         shards = os.listdir(data_root)
-        shards = [s for s in shards if split in s]
+        shards = [s for s in shards if split in s and not s.endswith(DOC_INDEX_SUFFIX)]
         shards = sorted(shards)
         shards = [os.path.join(data_root, s) for s in shards]
         self.shards = shards
         assert len(shards) > 0, f"no shards found for split {split}"
-        print(f"found {len(shards)} shards for split {split}")
+        if process_rank == 0:
+            print(f"found {len(shards)} shards for split {split}")
+
+        # optional shard-order shuffling, a fresh permutation for every epoch derived from the seed
+        self.shuffle = shuffle
+        self.seed = seed
+
+        # prefetching: a background thread keeps up to `prefetch` batches ready (in pinned memory if asked)
+        self.prefetch = prefetch
+        self.pin_memory = pin_memory
+        self.wait_time = 0.0  # total seconds next_batch spent waiting for data
+        self._thread = None
+        self._doc_indexes = {}  # shard file -> memory-mapped document offsets, loaded on first use
+        self._shard_tokens = {}  # shard file -> memory-mapped tokens for document access, opened on first use
         self.reset()
         
     def reset(self):
         # state, init at shard zero
-        self.current_shard = 0
-        self.tokens = load_tokens(self.shards[self.current_shard])
-        self.current_position = 0
-    
-    def set_state(self, shard):
+        self.set_state(0)
+
+    def shard_order(self, epoch):
+        if not self.shuffle:
+            return list(range(len(self.shards)))
+        return np.random.default_rng((self.seed, epoch)).permutation(len(self.shards)).tolist()
+
+    def _load_shard(self, shard, epoch):
+        # `shard` counts shards within the epoch, the epoch's order picks the actual file
+        return load_tokens(self.shards[self.shard_order(epoch)[shard]])
+
+    def set_state(self, shard, position=None, epoch=0):
+        # every rank starts at its own offset: ranks read interleaved, disjoint B*T slices of a shard
+        self._stop_prefetch()
         self.current_shard = shard
-        self.tokens = load_tokens(self.shards[self.current_shard])
-        self.current_position = 0
+        self.current_epoch = epoch
+        self.tokens = self._load_shard(shard, epoch)
+        self.current_position = self.B * self.T * self.process_rank if position is None else position
+        assert self.current_position + self.B * self.T + 1 <= len(self.tokens), \
+            f"position {self.current_position} is past the end of shard {shard} ({len(self.tokens)} tokens) for B={self.B}, T={self.T}"
+        if self.prefetch > 0:
+            self._start_prefetch()
 
-    def next_batch(self):
+    def state_dict(self):
+        # position is stored relative to this rank's offset, so it restores exactly on every rank
+        return {
+            'shard': self.current_shard,
+            'position': self.current_position - self.B * self.T * self.process_rank,
+            'epoch': self.current_epoch,
+            'seed': self.seed,
+            'num_processes': self.num_processes,
+        }
+
+    def load_state_dict(self, state):
+        assert state['num_processes'] == self.num_processes, "data loader state was saved with a different number of processes"
+        self.seed = state['seed']
+        self.set_state(state['shard'], state['position'] + self.B * self.T * self.process_rank, state['epoch'])
+
+    def _read_batch(self, shard, position, epoch, tokens):
+        """Reads the batch at (shard, position), returns it along with the state for the batch after it."""
         B, T = self.B, self.T
-        buf = self.tokens[self.current_position : self.current_position+B*T+1]
+        # only the B*T+1 tokens of this batch are read from the shard and widened to int64
+        buf = torch.from_numpy(tokens[position : position+B*T+1].astype(np.int64))
         x = (buf[:-1]).view(B, T) # inputs
         y = (buf[1:]).view(B, T) # targets
-        # advance the position in the tensor
-        self.current_position += B * T
-        # if loading the next batch would be out of bounds, advance to next shard
-        if self.current_position + (B * T + 1) > len(self.tokens):
-            self.current_shard = (self.current_shard + 1) % len(self.shards)
-            self.tokens = load_tokens(self.shards[self.current_shard])
-            self.current_position = 0
-        return x, y
\ No newline at end of file
+        # advance the position in the tensor, past the slices of all the other ranks
+        position += B * T * self.num_processes
+        # if the next batch of the last rank would be out of bounds, advance to next shard; every rank
+        # checks the same (last) slice, so all of them switch on the same step
+        if position - B * T * self.process_rank + B * T * self.num_processes + 1 > len(tokens):
+            shard += 1
+            if shard == len(self.shards):
+                shard, epoch = 0, epoch + 1
+            tokens = self._load_shard(shard, epoch)
+            position = B * T * self.process_rank
+        return x, y, shard, position, epoch, tokens
+
+    def _prefetch_worker(self, shard, position, epoch, tokens, batches, stop):
+        # runs ahead of the training loop, including the switch to the next shard
+        try:
+            while not stop.is_set():
+                x, y, shard, position, epoch, tokens = self._read_batch(shard, position, epoch, tokens)
+                if self.pin_memory:
+                    x, y = x.pin_memory(), y.pin_memory()
+                self._put(batches, stop, (x, y, shard, position, epoch))
+        except BaseException as e:
+            # hand the error to next_batch instead of dying silently and leaving it waiting forever
+            self._put(batches, stop, e)
+
+    @staticmethod
+    def _put(batches, stop, item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _start_prefetch(self):
+        self._stop = threading.Event()
+        self._batches = queue.Queue(maxsize=self.prefetch)
+        self._thread = threading.Thread(
+            target=self._prefetch_worker,
+            args=(self.current_shard, self.current_position, self.current_epoch, self.tokens, self._batches, self._stop),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def _stop_prefetch(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _get_prefetched(self):
+        while True:
+            try:
+                return self._batches.get(timeout=1.0)
+            except queue.Empty:
+                # a worker that died without reporting (its error was already queued or lost) must not block us
+                if not self._thread.is_alive() and self._batches.empty():
+                    raise RuntimeError("data loader prefetch worker exited without producing a batch")
+
+    def next_batch(self):
+        t0 = time.time()
+        if self._thread is not None:
+            # the state that comes with a batch is where the loader resumes after it, not where the worker is
+            item = self._get_prefetched()
+            if isinstance(item, BaseException):
+                self._thread.join()
+                self._thread = None
+                raise RuntimeError("data loader prefetch worker failed") from item
+            x, y, self.current_shard, self.current_position, self.current_epoch = item
+        else:
+            x, y, self.current_shard, self.current_position, self.current_epoch, self.tokens = self._read_batch(
+                self.current_shard, self.current_position, self.current_epoch, self.tokens)
+        self.wait_time += time.time() - t0
+        return x, y
+
+    def doc_offsets(self, shard_file):
+        """Start offsets of the documents in a shard, read from its index sidecar."""
+        if shard_file not in self._doc_indexes:
+            self._doc_indexes[shard_file] = load_doc_index(shard_file)
+        return self._doc_indexes[shard_file]
+
+    def shard_tokens(self, shard_file):
+        """Memory-mapped tokens of a shard, opened once instead of on every document lookup."""
+        if shard_file not in self._shard_tokens:
+            self._shard_tokens[shard_file] = load_tokens(shard_file)
+        return self._shard_tokens[shard_file]
+
+    def num_documents(self, shard_file):
+        return len(self.doc_offsets(shard_file))
+
+    def get_document(self, shard_file, doc_idx):
+        """Returns the tokens of one document (starting with its <|endoftext|>) without scanning the shard."""
+        offsets = self.doc_offsets(shard_file)
+        tokens = self.shard_tokens(shard_file)
+        start = int(offsets[doc_idx])
+        end = int(offsets[doc_idx + 1]) if doc_idx + 1 < len(offsets) else len(tokens)  # the last one may continue in the next shard
+        return torch.from_numpy(tokens[start:end].astype(np.int64))
+
+    def random_doc_batch(self, generator=None):
+        """Samples a (B, T) batch from the current shard where every row starts at a random document boundary."""
+        B, T = self.B, self.T
+        shard_file = self.shards[self.shard_order(self.current_epoch)[self.current_shard]]
+        offsets = self.doc_offsets(shard_file)
+        tokens = self.shard_tokens(shard_file)
+        # only documents with at least T+1 tokens left in the shard can start a full row
+        num_starts = int(np.searchsorted(offsets, len(tokens) - (T + 1), side='right'))
+        assert num_starts > 0, "shard too small for a document-aligned row of T+1 tokens"
+        picks = torch.randint(num_starts, (B,), generator=generator).tolist()
+        starts = [int(offsets[i]) for i in picks]
+        rows = [torch.from_numpy(tokens[start : start + T + 1].astype(np.int64)) for start in starts]
+        buf = torch.stack(rows)
+        return buf[:, :-1], buf[:, 1:]
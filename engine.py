@@ -0,0 +1,130 @@
+from collections import deque
+from dataclasses import dataclass, field
+import torch
+from torch.nn import functional as F
+from model import get_enc
+
+@dataclass
+class GenerationRequest:
+    prompt_tokens: list
+    max_length: int = 32  # total length including the prompt, as in GPT.generate
+    top_k: int = 50
+    request_id: int = 0
+    adapter: str = None  # name of a LoRA adapter loaded on the model, None for the base weights
+    tokens: list = field(default_factory=list)  # prompt + generated tokens
+    done: bool = False
+
+    @property
+    def generated_tokens(self):
+        return self.tokens[len(self.prompt_tokens):]
+
+class GenerationEngine:
+    """
+    Continuous-batching generation on top of GPT.
+
+    Every active sequence owns one row (slot) of a shared KV cache. Each `step` admits
+    queued requests into free slots, runs a single batched forward over the newest token
+    of all active sequences, and retires the sequences that finished so their slots can
+    be reused by the queue on the next step.
+
+    With `max_cache_bytes` set the cache is paged: a request is only admitted once enough
+    blocks are free to hold its full `max_length`, and its blocks go back to the pool as
+    soon as it finishes, so the cache never grows past the budget.
+
+    Requests may name a LoRA adapter loaded with GPT.load_adapter; sequences with
+    different adapters share a batch, each row running with its own adapter.
+    """
+    def __init__(self, model, max_batch_size=8, max_len=None, eos_token=None, max_cache_bytes=None, block_len=16):
+        self.model = model
+        self.model.eval()
+        self.device = model.transformer.wpe.weight.device
+        self.eos_token = eos_token
+
+        if max_cache_bytes is not None:
+            self.kv_cache = model.init_paged_kv_cache(max_cache_bytes, block_len=block_len)
+        else:
+            self.kv_cache = model.init_kv_cache(max_batch_size, max_len)
+        self.free_slots = list(range(max_batch_size))
+        self.queue = deque()
+        self.active = {}  # slot -> request
+        self.finished = []
+        self.num_requests = 0
+
+    def add_request(self, prompt, max_length=32, top_k=50, adapter=None):
+        """Queues a prompt (a string or a list of token ids) and returns its request object."""
+        prompt_tokens = get_enc().encode(prompt) if isinstance(prompt, str) else list(prompt)
+        assert 0 < len(prompt_tokens) < max_length, "prompt must be non-empty and shorter than max_length"
+        assert max_length <= self.model.config.block_size, f"max_length {max_length} exceeds the block size {self.model.config.block_size}"
+        assert max_length <= self.kv_cache.max_len, f"max_length {max_length} can never fit in the KV cache ({self.kv_cache.max_len} positions)"
+        assert adapter is None or adapter in self.model.transformer.h[0].attn.adapters, f"adapter {adapter} is not loaded"
+        request = GenerationRequest(prompt_tokens, max_length=max_length, top_k=top_k, request_id=self.num_requests, adapter=adapter)
+        request.tokens = list(prompt_tokens)
+        self.num_requests += 1
+        self.queue.append(request)
+        return request
+
+    def has_work(self):
+        return len(self.queue) > 0 or len(self.active) > 0
+
+    def _admit(self):
+        while self.queue and self.free_slots:
+            if not self.kv_cache.can_allocate(self.queue[0].max_length):
+                break  # wait for running sequences to give their cache memory back
+            request = self.queue.popleft()
+            slot = self.free_slots.pop(0)
+            self.kv_cache.allocate(slot, request.max_length)
+            # prefill everything but the last prompt token, which is fed by the next decode step
+            if len(request.prompt_tokens) > 1:
+                idx = torch.tensor([request.prompt_tokens[:-1]], dtype=torch.long, device=self.device)
+                rows = torch.tensor([slot], dtype=torch.long, device=self.device)
+                adapters = [request.adapter] if request.adapter is not None else None
+                self.model(idx, kv_cache=self.kv_cache.select(rows), adapters=adapters, logit_positions=slice(0, 0))  # only fills the cache
+            self.active[slot] = request
+
+    def _sample(self, logits, top_ks):
+        # top-k sampling where every row may use its own k
+        probs = F.softmax(logits, dim=-1)
+        topk_probs, topk_indices = torch.topk(probs, max(top_ks), dim=-1)
+        k = torch.tensor(top_ks, device=probs.device)
+        topk_probs = topk_probs.masked_fill(torch.arange(topk_probs.size(-1), device=probs.device) >= k[:, None], 0.0)
+        ix = torch.multinomial(topk_probs, 1)
+        return torch.gather(topk_indices, -1, ix).squeeze(-1)
+
+    @torch.no_grad()
+    def step(self):
+        """Runs one batched decoding step and returns the requests that finished in it."""
+        self._admit()
+        if not self.active:
+            return []
+
+        slots = list(self.active.keys())
+        requests = [self.active[s] for s in slots]
+        idx = torch.tensor([[r.tokens[-1]] for r in requests], dtype=torch.long, device=self.device)
+        start_pos = torch.tensor([len(r.tokens) - 1 for r in requests], dtype=torch.long, device=self.device)
+        rows = torch.tensor(slots, dtype=torch.long, device=self.device)
+
+        adapters = [r.adapter for r in requests]
+        adapters = adapters if any(a is not None for a in adapters) else None
+        logits, _ = self.model(idx, kv_cache=self.kv_cache.select(rows), start_pos=start_pos, adapters=adapters)
+        next_tokens = self._sample(logits[:, -1, :], [r.top_k for r in requests]).tolist()
+
+        finished = []
+        for slot, request, token in zip(slots, requests, next_tokens):
+            request.tokens.append(token)
+            if len(request.tokens) >= request.max_length or token == self.eos_token:
+                request.done = True
+                finished.append(request)
+                del self.active[slot]
+                self.kv_cache.free(slot)
+                self.free_slots.append(slot)
+        self.finished.extend(finished)
+        return finished
+
+    def run(self):
+        """Steps until every queued and active request has finished, returns them in request order."""
+        while self.has_work():
+            self.step()
+        return sorted(self.finished, key=lambda r: r.request_id)
+
+    def decode(self, request):
+        return get_enc().decode(request.tokens)
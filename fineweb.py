@@ -1,8 +1,12 @@
 import os
+import json
+import argparse
+import multiprocessing as mp
 import numpy as np
 import tiktoken
 from datasets import load_dataset
-from tqdm import tqdm 
+from tqdm import tqdm
+from dataloader import DOC_INDEX_SUFFIX, build_doc_index, doc_index_filename
 
 # ------------------------------------------
 local_dir = "edu_fineweb10B"
@@ -12,9 +16,8 @@ shard_size = int(1e8) # 100M tokens per shard, total of 100 shards
 # create the cache the local directory if it doesn't exist yet
 DATA_CACHE_DIR = os.path.join(os.path.dirname(__file__), local_dir)
 os.makedirs(DATA_CACHE_DIR, exist_ok=True)
-
-# download the dataset
-fw = load_dataset("HuggingFaceFW/fineweb-edu", name=remote_name, split="train")
+# progress manifest, rewritten after every completed shard so an interrupted run can resume
+MANIFEST_PATH = os.path.join(DATA_CACHE_DIR, "manifest.json")
 
 # init the tokenizer
 enc = tiktoken.get_encoding("gpt2")
@@ -30,43 +33,105 @@ def tokenize(doc):
 
 def write_datafile(filename, tokens_np):
     np.save(filename, tokens_np)
+    # sidecar with the offset of every document start, so readers never have to scan the shard for them
+    np.save(doc_index_filename(filename + ".npy"), build_doc_index(tokens_np, eot))
 
-# tokenize all documents and write output shards, each of shard_size tokens (last shard has remainder)
-shard_index = 0
-# preallocate buffer to hold current shard
-all_tokens_np = np.empty((shard_size,), dtype=np.uint16)
-token_count = 0
-progress_bar = None
-
-for doc in tqdm(fw, desc="Processing documents"):
-    tokens = tokenize(doc)
-    
-    # is there enough space in the current shard for the new tokens?
-    if token_count + len(tokens) < shard_size:
-        # simply append tokens to current shard
-        all_tokens_np[token_count:token_count+len(tokens)] = tokens
-        token_count += len(tokens)
-        # update progress bar
-        if progress_bar is None:
-            progress_bar = tqdm(total=shard_size, unit="tokens", desc=f"Shard {shard_index}")
-        progress_bar.update(len(tokens))
-    else:
-        # write the current shard and start a new one
-        split = "val" if shard_index == 0 else "train"
-        filename = os.path.join(DATA_CACHE_DIR, f"edufineweb_{split}_{shard_index:06d}")
-        # split the document into whatever fits in this shard; the remainder goes to next one
-        remainder = shard_size - token_count
-        progress_bar.update(remainder)
-        all_tokens_np[token_count:token_count+remainder] = tokens[:remainder]
-        write_datafile(filename, all_tokens_np)
-        shard_index += 1
-        progress_bar = None
-        # populate the next shard with the leftovers of the current doc
-        all_tokens_np[0:len(tokens)-remainder] = tokens[remainder:]
-        token_count = len(tokens)-remainder
+def backfill_doc_indexes():
+    # one-time pass over shards written before the document index existed
+    shards = sorted(s for s in os.listdir(DATA_CACHE_DIR) if s.startswith("edufineweb_") and s.endswith(".npy") and not s.endswith(DOC_INDEX_SUFFIX))
+    for s in tqdm(shards, desc="Backfilling document indexes"):
+        shard_path = os.path.join(DATA_CACHE_DIR, s)
+        index_path = doc_index_filename(shard_path)
+        if not os.path.exists(index_path):
+            np.save(index_path, build_doc_index(np.load(shard_path, mmap_mode='r'), eot))
 
-# write any remaining tokens as the last shard
-if token_count != 0:
+def shard_filename(shard_index):
     split = "val" if shard_index == 0 else "train"
-    filename = os.path.join(DATA_CACHE_DIR, f"edufineweb_{split}_{shard_index:06d}")
-    write_datafile(filename, all_tokens_np[:token_count])
\ No newline at end of file
+    return os.path.join(DATA_CACHE_DIR, f"edufineweb_{split}_{shard_index:06d}")
+
+def load_manifest():
+    # where to pick up: the next shard to write, and the document (and offset into it) it starts with
+    state = {"remote_name": remote_name, "shard_size": shard_size, "shard_index": 0, "next_doc": 0, "doc_offset": 0, "done": False}
+    if os.path.exists(MANIFEST_PATH):
+        with open(MANIFEST_PATH, "r") as f:
+            saved = json.load(f)
+        assert saved["remote_name"] == remote_name and saved["shard_size"] == shard_size, "manifest was written for a different dataset or shard size"
+        state.update(saved)
+    return state
+
+def save_manifest(state):
+    # write to a temporary file and rename it into place, so a crash never leaves a torn manifest
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backfill_index", action="store_true", help="write missing document indexes for existing shards and exit")
+    args = parser.parse_args()
+    if args.backfill_index:
+        backfill_doc_indexes()
+        raise SystemExit
+
+    state = load_manifest()
+    if state["done"]:
+        print(f"all shards already written, see {MANIFEST_PATH}")
+        raise SystemExit
+
+    # download the dataset
+    fw = load_dataset("HuggingFaceFW/fineweb-edu", name=remote_name, split="train")
+    start_doc = state["next_doc"]
+    if start_doc > 0:
+        print(f"resuming at shard {state['shard_index']}, document {start_doc}")
+        fw = fw.select(range(start_doc, len(fw)))
+
+    # tokenize all documents and write output shards, each of shard_size tokens (last shard has remainder)
+    shard_index = state["shard_index"]
+    # preallocate buffer to hold current shard
+    all_tokens_np = np.empty((shard_size,), dtype=np.uint16)
+    token_count = 0
+    progress_bar = None
+
+    # documents are tokenized in parallel chunks, imap hands them back in document order so shards are deterministic
+    nprocs = max(1, os.cpu_count() // 2)
+    with mp.Pool(nprocs) as pool:
+        for doc_index, tokens in enumerate(pool.imap(tokenize, fw, chunksize=16), start=start_doc):
+            if doc_index == start_doc:
+                tokens = tokens[state["doc_offset"]:] # the head of this document went into the previous shard
+
+            # is there enough space in the current shard for the new tokens?
+            if token_count + len(tokens) < shard_size:
+                # simply append tokens to current shard
+                all_tokens_np[token_count:token_count+len(tokens)] = tokens
+                token_count += len(tokens)
+                # update progress bar
+                if progress_bar is None:
+                    progress_bar = tqdm(total=shard_size, unit="tokens", desc=f"Shard {shard_index}")
+                progress_bar.update(len(tokens))
+            else:
+                # write the current shard and start a new one
+                filename = shard_filename(shard_index)
+                # split the document into whatever fits in this shard; the remainder goes to next one
+                remainder = shard_size - token_count
+                if progress_bar is not None:
+                    progress_bar.update(remainder)
+                all_tokens_np[token_count:token_count+remainder] = tokens[:remainder]
+                write_datafile(filename, all_tokens_np)
+                shard_index += 1
+                progress_bar = None
+                # record progress: the next shard starts with the rest of this document
+                offset = remainder + (state["doc_offset"] if doc_index == start_doc else 0)
+                state.update(shard_index=shard_index, next_doc=doc_index, doc_offset=offset)
+                save_manifest(state)
+                # populate the next shard with the leftovers of the current doc
+                all_tokens_np[0:len(tokens)-remainder] = tokens[remainder:]
+                token_count = len(tokens)-remainder
+
+    # write any remaining tokens as the last shard
+    if token_count != 0:
+        filename = shard_filename(shard_index)
+        write_datafile(filename, all_tokens_np[:token_count])
+        shard_index += 1
+    state.update(shard_index=shard_index, done=True)
+    save_manifest(state)
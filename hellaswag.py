@@ -5,7 +5,7 @@ import tiktoken
 from tqdm import tqdm
 import torch
 import torch.nn as nn
-from torch.nn import functional as F
+import torch.distributed as dist
 from model import GPT, GPTConfig
 
 # -----------------------------------------------------------------------------
@@ -41,7 +41,10 @@ def download(split):
     data_filename = os.path.join(DATA_CACHE_DIR, f"hellaswag_{split}.jsonl")
     if not os.path.exists(data_filename):
         print(f"Downloading {data_url} to {data_filename}...")
-        download_file(data_url, data_filename)
+        # download under a temporary name and rename, ranks downloading at the same time never read a partial file
+        tmp_filename = f"{data_filename}.{os.getpid()}.tmp"
+        download_file(data_url, tmp_filename)
+        os.replace(tmp_filename, data_filename)
 
 def render_example(example):
     """
@@ -90,6 +93,57 @@ def iterate_examples(split):
             example = json.loads(line)
             yield example
 
+def load_rendered(split):
+    """
+    Returns the (ctx_tokens, ending_tokens, label) of every example in the split. The rendering is
+    cached to disk on first use, so later evaluations skip tiktoken entirely.
+    """
+    cache_filename = os.path.join(DATA_CACHE_DIR, f"hellaswag_{split}_tokens.pt")
+    if os.path.exists(cache_filename):
+        return torch.load(cache_filename)
+    rendered = []
+    for example in iterate_examples(split):
+        data, _, _, label = render_example(example)
+        rendered.append((data["ctx_tokens"], data["ending_tokens"], label))
+    # write under a temporary name and rename, so ranks rendering at the same time never see a partial file
+    tmp_filename = f"{cache_filename}.{os.getpid()}.tmp"
+    torch.save(rendered, tmp_filename)
+    os.replace(tmp_filename, cache_filename)
+    return rendered
+
+@torch.no_grad()
+def evaluate_batched(model, device, split="val", batch_size=32, process_rank=0, num_processes=1):
+    """
+    Evaluates `model` on HellaSwag, scoring `batch_size` examples per call to GPT.score_continuations,
+    which runs each context once and scores the 4 endings on its cached keys/values.
+    Each process scores an interleaved share of the examples, and the counts are summed across
+    processes when torch.distributed is initialized. Returns (num_correct_norm, num_correct, num_total).
+    """
+    model.eval()
+    device_type = "cuda" if str(device).startswith("cuda") else "cpu"
+    examples = load_rendered(split)[process_rank::num_processes]
+    counts = torch.zeros(3, dtype=torch.long, device=device)  # correct_norm, correct, total
+    for i in range(0, len(examples), batch_size):
+        batch = examples[i:i+batch_size]
+        contexts = [ctx_tokens for ctx_tokens, _, _ in batch]
+        endings = [ending_tokens for _, ending_tokens, _ in batch]
+        labels = torch.tensor([label for _, _, label in batch], device=device)
+
+        # summed and length-normalized loss of every ending, the one with the lowest loss is the prediction
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=device_type == "cuda"):
+            sum_loss, avg_loss = model.score_continuations(contexts, endings)
+        pred = sum_loss.view(-1, 4).argmin(dim=1)
+        pred_norm = avg_loss.view(-1, 4).argmin(dim=1)
+
+        counts[0] += (pred_norm == labels).sum()
+        counts[1] += (pred == labels).sum()
+        counts[2] += len(batch)
+
+    if dist.is_available() and dist.is_initialized():
+        dist.all_reduce(counts, op=dist.ReduceOp.SUM)
+    num_correct_norm, num_correct, num_total = counts.tolist()
+    return num_correct_norm, num_correct, num_total
+
 @torch.no_grad()
 def evaluate(device):
 
@@ -104,48 +158,9 @@ def evaluate(device):
         model.load_state_dict(checkpoint['model'])
     # model = torch.compile(model) # optionally torch compile the model
 
-    num_correct_norm = 0
-    num_correct = 0
-    num_total = 0
-    for example in iterate_examples("val"):
-        data, tokens, mask, label = render_example(example)
-        tokens = tokens.to(device)
-        mask = mask.to(device)
-
-        # get the logits
-        logits = model(tokens).logits
-        # evaluate the autoregressive loss at all positions
-        shift_logits = (logits[..., :-1, :]).contiguous()
-        shift_tokens = (tokens[..., 1:]).contiguous()
-        flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
-        flat_shift_tokens = shift_tokens.view(-1)
-        shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
-        shift_losses = shift_losses.view(tokens.size(0), -1)
-        # now get the average loss just for the completion region (where mask == 1), in each row
-        shift_mask = (mask[..., 1:]).contiguous() # we must shift mask, so we start at the last prompt token
-        masked_shift_losses = shift_losses * shift_mask
-        # sum and divide by the number of 1s in the mask
-        sum_loss = masked_shift_losses.sum(dim=1)
-        avg_loss = sum_loss / shift_mask.sum(dim=1)
-        # now we have a loss for each of the 4 completions
-        # the one with the lowest loss should be the most likely
-        pred = sum_loss.argmin().item()
-        pred_norm = avg_loss.argmin().item()
-
-        # accumulate stats
-        num_total += 1
-        num_correct += int(pred == label)
-        num_correct_norm += int(pred_norm == label)
-        print(f"{num_total} acc_norm: {num_correct_norm}/{num_total}={num_correct_norm/num_total:.4f}")
-
-        # debug: pretty print a few examples, and the losses in each case
-        if num_total < 10:
-            print("---")
-            print(f"Context:\n {example['ctx']}")
-            print(f"Endings:")
-            for i, end in enumerate(example["endings"]):
-                print(f"{i} (loss: {avg_loss[i].item():.4f}) {end}")
-            print(f"predicted: {pred_norm}, actual: {label}")
+    num_correct_norm, num_correct, num_total = evaluate_batched(model, device)
+    print(f"acc: {num_correct}/{num_total}={num_correct/num_total:.4f}")
+    print(f"acc_norm: {num_correct_norm}/{num_total}={num_correct_norm/num_total:.4f}")
 
 if __name__ == "__main__":
     import argparse
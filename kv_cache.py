@@ -0,0 +1,274 @@
+import copy
+from collections import OrderedDict
+import torch
+
+class KVCache:
+    """
+    Preallocated key/value buffers for incremental decoding, one pair per layer.
+    Keys and values are written in place at their absolute positions, so each
+    decoding step only does the work for the new tokens.
+
+    A static cache hands back the whole max_len buffer for per-row (tensor) offsets instead
+    of slicing it to the longest row, so decode steps always see the same shapes (the
+    attention mask hides the unused tail). That is what lets a compiled decode step run
+    without recompiling or syncing with the host.
+    """
+    rotates_keys = False  # update() takes keys with RoPE already applied
+
+    def __init__(self, n_layer, batch_size, n_head, max_len, head_dim, device='cpu', dtype=torch.float32, static=False):
+        self.batch_size = batch_size
+        self.max_len = max_len
+        self.static = static
+        shape = (batch_size, n_head, max_len, head_dim)
+        self.k = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(n_layer)]
+        self.v = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(n_layer)]
+        self.rows = None  # cache rows used by the current batch, None means all of them in order
+
+    def select(self, rows):
+        """Returns a view of the cache whose batch rows map onto the given cache rows (slots)."""
+        view = copy.copy(self)
+        view.rows = rows
+        return view
+
+    def update(self, layer_idx, k, v, start_pos):
+        # write the new keys/values at [start_pos, start_pos + T) and return everything up to there
+        cache_k, cache_v = self.k[layer_idx], self.v[layer_idx]
+        T = k.size(2)
+        if torch.is_tensor(start_pos):
+            # per-row offsets: scatter each row's keys/values to its own positions
+            rows = self.rows if self.rows is not None else torch.arange(k.size(0), device=k.device)
+            pos = start_pos[:, None] + torch.arange(T, device=k.device)  # (B, T)
+            if self.static:
+                cache_k[rows[:, None], :, pos] = k.transpose(1, 2)
+                cache_v[rows[:, None], :, pos] = v.transpose(1, 2)
+                return cache_k[rows], cache_v[rows]
+            end = int(pos.max()) + 1
+            assert end <= self.max_len, f"KV cache overflow: position {end} exceeds max_len {self.max_len}"
+            cache_k[rows[:, None], :, pos] = k.transpose(1, 2)
+            cache_v[rows[:, None], :, pos] = v.transpose(1, 2)
+            return cache_k[rows, :, :end], cache_v[rows, :, :end]
+
+        end = start_pos + T
+        assert end <= self.max_len, f"KV cache overflow: position {end} exceeds max_len {self.max_len}"
+        if self.rows is not None:
+            cache_k[self.rows, :, start_pos:end] = k
+            cache_v[self.rows, :, start_pos:end] = v
+            return cache_k[self.rows, :, :end], cache_v[self.rows, :, :end]
+        cache_k[:, :, start_pos:end] = k
+        cache_v[:, :, start_pos:end] = v
+        return cache_k[:, :, :end], cache_v[:, :, :end]
+
+    def copy_rows(self, src_rows, dst_rows, length):
+        """Copies the first `length` positions of `src_rows` into `dst_rows`, e.g. to share one prefill across rows."""
+        for cache_k, cache_v in zip(self.k, self.v):
+            cache_k[dst_rows, :, :length] = cache_k[src_rows, :, :length]
+            cache_v[dst_rows, :, :length] = cache_v[src_rows, :, :length]
+
+    def can_allocate(self, num_tokens, seq_id=None):
+        return num_tokens <= self.max_len
+
+    def allocate(self, seq_id, num_tokens):
+        # every row owns a full max_len slot, so there is nothing to hand out
+        assert self.can_allocate(num_tokens), f"cannot hold {num_tokens} tokens, max_len is {self.max_len}"
+
+    def free(self, seq_id):
+        pass
+
+class SinkKVCache(KVCache):
+    """
+    Fixed-size KV cache for unbounded streaming generation: the first `num_sinks` tokens
+    ("attention sinks") are kept forever, followed by a rolling window of the most recent
+    `window` tokens. Memory and per-token cost stay constant however long the stream runs.
+
+    Positions are reassigned inside the cache rather than taken from the text, so the model
+    never sees a position past num_sinks + window. Keys are cached before RoPE and rotated
+    by their current slot whenever they are read, so when the window slides down on eviction
+    the surviving keys simply take the angles of their new slots. The learned wpe is folded
+    into the cached keys/values when they are computed and can't be moved, new tokens get
+    the wpe of their cache slot.
+    """
+    rotates_keys = True  # update() takes keys before RoPE and returns them rotated
+
+    def __init__(self, n_layer, batch_size, n_head, num_sinks, window, head_dim, rope, device='cpu', dtype=torch.float32):
+        assert num_sinks >= 0 and window > 0, "need a non-empty window"
+        super().__init__(n_layer, batch_size, n_head, num_sinks + window, head_dim, device=device, dtype=dtype)
+        self.num_sinks = num_sinks
+        self.window = window
+        self.rope_cos, self.rope_sin = rope  # the model's shared RoPE table
+        self.length = 0  # number of cached positions
+
+    def make_room(self, num_tokens):
+        """
+        Evicts the oldest window tokens so `num_tokens` new ones fit, and returns the cache
+        position to run them at (the start_pos of the next forward).
+        """
+        assert num_tokens <= self.window, f"cannot feed {num_tokens} tokens at once into a window of {self.window}"
+        shift = self.length + num_tokens - self.max_len
+        if shift > 0:
+            s, end = self.num_sinks, self.length
+            for cache_k, cache_v in zip(self.k, self.v):
+                cache_k[:, :, s:end - shift] = cache_k[:, :, s + shift:end].clone()
+                cache_v[:, :, s:end - shift] = cache_v[:, :, s + shift:end].clone()
+            self.length -= shift
+        start_pos = self.length
+        self.length += num_tokens
+        return start_pos
+
+    def update(self, layer_idx, k, v, start_pos):
+        from model import apply_rope  # model imports this module
+        k, v = super().update(layer_idx, k, v, start_pos)
+        end = k.size(2)
+        return apply_rope(k, self.rope_cos[:end], self.rope_sin[:end]).to(k.dtype), v
+
+class PagedKVCache:
+    """
+    Block-based (paged) key/value store shared by all layers of a model.
+
+    A fixed pool of blocks, each holding `block_len` positions for every layer, is carved
+    out of a byte budget up front. Sequences are handed blocks as they need them and give
+    them back when they finish, so memory never grows past the budget and one long
+    sequence can't starve many short ones of memory they would actually use.
+    """
+    rotates_keys = False
+
+    def __init__(self, n_layer, n_head, head_dim, max_bytes, block_len=16, device='cpu', dtype=torch.float32):
+        self.block_len = block_len
+        element_size = torch.tensor([], dtype=dtype).element_size()
+        self.bytes_per_block = 2 * n_layer * n_head * block_len * head_dim * element_size  # keys and values
+        self.num_blocks = max_bytes // self.bytes_per_block
+        assert self.num_blocks > 0, f"budget of {max_bytes} bytes is smaller than one block ({self.bytes_per_block} bytes)"
+        self.max_len = self.num_blocks * block_len
+
+        shape = (n_layer, self.num_blocks, n_head, block_len, head_dim)
+        self.k = torch.zeros(shape, device=device, dtype=dtype)
+        self.v = torch.zeros(shape, device=device, dtype=dtype)
+        self.free_blocks = list(range(self.num_blocks - 1, -1, -1))  # stack, lowest block id on top
+        self.block_tables = {}  # seq_id -> list of block ids in position order
+        self.block_table = None  # (B, max_blocks) block ids of the current batch, set by select
+        self.row_blocks = None  # (B,) number of blocks each row of the current batch owns
+
+    @property
+    def blocks_in_use(self):
+        return self.num_blocks - len(self.free_blocks)
+
+    @property
+    def bytes_in_use(self):
+        return self.blocks_in_use * self.bytes_per_block
+
+    def _blocks_needed(self, seq_id, num_tokens):
+        have = len(self.block_tables.get(seq_id, []))
+        return max(0, -(-num_tokens // self.block_len) - have)
+
+    def can_allocate(self, num_tokens, seq_id=None):
+        return self._blocks_needed(seq_id, num_tokens) <= len(self.free_blocks)
+
+    def allocate(self, seq_id, num_tokens):
+        """Makes sure `seq_id` owns enough blocks to hold `num_tokens` positions."""
+        needed = self._blocks_needed(seq_id, num_tokens)
+        if needed > len(self.free_blocks):
+            raise RuntimeError(f"paged KV cache out of blocks: need {needed}, {len(self.free_blocks)} free")
+        table = self.block_tables.setdefault(seq_id, [])
+        for _ in range(needed):
+            table.append(self.free_blocks.pop())
+
+    def free(self, seq_id):
+        """Returns all blocks of a finished sequence to the pool."""
+        self.free_blocks.extend(reversed(self.block_tables.pop(seq_id, [])))
+
+    def select(self, seq_ids):
+        """Returns a view of the cache whose batch rows are the given sequences."""
+        seq_ids = seq_ids.tolist() if torch.is_tensor(seq_ids) else list(seq_ids)
+        tables = [self.block_tables[s] for s in seq_ids]
+        width = max(len(t) for t in tables)
+        padded = [t + [0] * (width - len(t)) for t in tables]  # padding slots are never attended to
+        view = copy.copy(self)
+        view.block_table = torch.tensor(padded, dtype=torch.long, device=self.k.device)
+        view.row_blocks = torch.tensor([len(t) for t in tables], dtype=torch.long, device=self.k.device)
+        return view
+
+    def update(self, layer_idx, k, v, start_pos):
+        assert self.block_table is not None, "select the batch's sequences before running the model"
+        B, H, T, D = k.size()
+        offset = start_pos[:, None] if torch.is_tensor(start_pos) else start_pos
+        pos = offset + torch.arange(T, device=k.device).expand(B, T)  # (B, T)
+        end = int(pos.max()) + 1
+        block_idx = pos // self.block_len
+        assert bool((block_idx < self.row_blocks[:, None]).all()), "sequence outgrew its allocated blocks"
+
+        # scatter the new keys/values into their (block, offset-in-block) slots
+        blocks = self.block_table.gather(1, block_idx)
+        slots = pos % self.block_len
+        self.k[layer_idx][blocks, :, slots] = k.transpose(1, 2)
+        self.v[layer_idx][blocks, :, slots] = v.transpose(1, 2)
+
+        # gather each row's blocks back into a contiguous (B, H, S, D) view
+        k_all = self.k[layer_idx][self.block_table].permute(0, 2, 1, 3, 4).reshape(B, H, -1, D)
+        v_all = self.v[layer_idx][self.block_table].permute(0, 2, 1, 3, 4).reshape(B, H, -1, D)
+        return k_all[:, :, :end], v_all[:, :, :end]
+
+class PrefixCache:
+    """
+    LRU cache of per-layer keys/values for prompts that were already processed.
+
+    Because attention is causal, the keys/values of the first n tokens only depend on
+    those n tokens, so any stored prompt sharing a prefix with a new prompt can seed the
+    KV cache for that shared part and only the remaining suffix has to be prefilled.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # tuple(tokens) -> (tokens tensor, [k per layer], [v per layer]), oldest first
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _entry_bytes(k, v):
+        return sum(t.numel() * t.element_size() for t in k + v)
+
+    def longest_prefix(self, tokens):
+        """Returns (key, length) of the stored prompt sharing the longest prefix with `tokens`."""
+        query = torch.tensor(tokens, dtype=torch.long)
+        best_key, best_len = None, 0
+        for key, (stored, _, _) in self.entries.items():
+            n = min(len(stored), len(query))
+            mismatch = (stored[:n] != query[:n]).nonzero()
+            common = int(mismatch[0]) if len(mismatch) > 0 else n
+            if common > best_len:
+                best_key, best_len = key, common
+        return best_key, best_len
+
+    def load(self, tokens, kv_cache, max_len=None):
+        """
+        Copies the keys/values of the longest cached prefix of `tokens` (at most `max_len`
+        positions) into every row of `kv_cache` and returns how many positions were filled.
+        """
+        key, length = self.longest_prefix(tokens)
+        length = min(length, max_len) if max_len is not None else length
+        if key is None or length == 0:
+            self.misses += 1
+            return 0
+        self.hits += 1
+        self.entries.move_to_end(key)
+        _, k, v = self.entries[key]
+        for layer_idx in range(len(k)):
+            kv_cache.k[layer_idx][:, :, :length] = k[layer_idx][:, :length]
+            kv_cache.v[layer_idx][:, :, :length] = v[layer_idx][:, :length]
+        return length
+
+    def insert(self, tokens, kv_cache, row=0):
+        """Stores the keys/values of `tokens`, already written to `row` of `kv_cache`."""
+        key = tuple(tokens)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        n = len(tokens)
+        k = [layer_k[row, :, :n].clone() for layer_k in kv_cache.k]
+        v = [layer_v[row, :, :n].clone() for layer_v in kv_cache.v]
+        size = self._entry_bytes(k, v)
+        if size > self.max_bytes:
+            return  # would never fit, don't flush everything else for it
+        self.entries[key] = (torch.tensor(tokens, dtype=torch.long), k, v)
+        self.bytes_used += size
+        while self.bytes_used > self.max_bytes:
+            _, (_, old_k, old_v) = self.entries.popitem(last=False)  # evict the least recently used
+            self.bytes_used -= self._entry_bytes(old_k, old_v)
@@ -1,4 +1,6 @@
 from model import GPT, GPTConfig
+from quantize import load_quantized
+from compiled import CompiledGPT
 import torch
 from torch.nn import functional as F
 import os
@@ -7,13 +9,26 @@ device = "cpu"
 if hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
     device = "mps"
 
-model = GPT(GPTConfig(vocab_size=50304))
-model.to(device)
-
 log_dir = "log"
 checkpoint_path = os.path.join(log_dir, "latest_checkpoint.pt")
-if os.path.exists(checkpoint_path):
-    checkpoint = torch.load(checkpoint_path, map_location=device)
-    model.load_state_dict(checkpoint['model'])
+# a quantized checkpoint written by quantize.py (int8, else int4) is used directly when present
+quantized_paths = [os.path.join(log_dir, f"arcane_int{bits}.pt") for bits in (8, 4)]
+quantized_path = next((p for p in quantized_paths if os.path.exists(p)), None)
+if quantized_path is not None:
+    print(f"using quantized checkpoint {quantized_path}")
+    model = load_quantized(quantized_path, device=device)
+else:
+    model = GPT(GPTConfig(vocab_size=50304))
+    model.to(device)
+    if os.path.exists(checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+        model.load_state_dict(checkpoint['model'])
+
+# opt-in torch.compile of the prefill and decode steps, compiled up front for this batch size and length
+compiled = None
+use_compile = False
+if use_compile:
+    compiled = CompiledGPT(model)
+    compiled.warmup(batch_size=3, max_len=32)
 
-model.generate("Hello, I'm a language model,", max_length=32, num_return_sequences=3, device=device)
+model.generate("Hello, I'm a language model,", max_length=32, num_return_sequences=3, device=device, compiled=compiled)
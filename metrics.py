@@ -0,0 +1,83 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+import torch
+
+def flops_per_token(config, T):
+    """
+    Training FLOPs (forward + backward) per token of a GPT with this config at sequence
+    length T: 6 per weight for the matmuls plus 12 * n_layer * n_embd * T for the
+    attention scores and weighted values, as in the PaLM paper's MFU appendix.
+    """
+    C, L = config.n_embd, config.n_layer
+    KV = (config.n_kv_head or config.n_head) * (C // config.n_head)  # width of the keys and of the values
+    block = C * (C + 2 * KV) + (C + 2 * KV) + (C * C + C) + (8 * C * C + 5 * C) + 4 * C  # c_attn, c_proj, MLP, layer norms
+    N = L * block + config.vocab_size * C + 2 * C  # blocks, tied embedding/lm_head, final layer norm
+    return 6 * N + 12 * L * C * T
+
+class StepTimer:
+    """
+    Wall-clock time of the named phases of a training step, summed over micro steps.
+
+    CUDA kernels run asynchronously, so with `sync` every phase boundary synchronizes the
+    device; that costs a little throughput but charges the time to the phase that did the
+    work. Phases also show up as labelled ranges in torch.profiler traces.
+    """
+    def __init__(self, sync=False):
+        self.sync = sync
+        self.reset()
+
+    def reset(self):
+        self.samples = {}  # phase -> durations of this step, one per time it ran
+
+    @contextmanager
+    def phase(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self.samples.setdefault(name, []).append(time.perf_counter() - t0)
+
+    def total(self, name):
+        return sum(self.samples.get(name, []))
+
+class StepProfiler:
+    """Captures a torch.profiler trace of the steps in [start, end) and writes it as a Chrome trace to `path`."""
+    def __init__(self, start, end, path, device_type):
+        self.start = start
+        self.end = end
+        self.path = path
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device_type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, with_stack=False)
+
+    def step_begin(self, step):
+        if step == self.start:
+            self.profiler.start()
+
+    def step_end(self, step):
+        if self.start <= step < self.end:
+            self.profiler.step()
+        if step == self.end - 1:
+            self.profiler.stop()
+            self.profiler.export_chrome_trace(self.path)
+            print(f"wrote profiler trace of steps {self.start}-{self.end - 1} to {self.path}")
+
+class MetricsLogger:
+    """Appends one JSON object per line, so runs can be compared phase by phase with any JSON tooling."""
+    def __init__(self, path, enabled=True, append=False):
+        self.path = path
+        self.enabled = enabled
+        if enabled and not append and os.path.exists(path):
+            os.remove(path)
+
+    def log(self, **fields):
+        if not self.enabled:
+            return
+        with open(self.path, "a") as f:
+            f.write(json.dumps(fields) + "\n")
@@ -1,8 +1,90 @@
 from dataclasses import dataclass
+import functools
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from torch.nn import functional as F
 import tiktoken
+from kv_cache import KVCache, PagedKVCache, SinkKVCache
+
+@functools.lru_cache(maxsize=None)
+def get_enc():
+    # one GPT-2 tokenizer for the whole process, shared by generation, the engine and the streaming API.
+    # Built on first use: loading it may download the BPE files, which tools that never tokenize shouldn't need
+    return tiktoken.get_encoding('gpt2')
+
+def top_k_probs(logits, top_k):
+    """Probabilities of top-k sampling over the full vocabulary: softmax restricted to the k largest logits."""
+    probs = F.softmax(logits, dim=-1)
+    topk_probs, topk_indices = torch.topk(probs, top_k, dim=-1)
+    topk_probs = topk_probs / topk_probs.sum(dim=-1, keepdim=True)
+    return torch.zeros_like(probs).scatter_(-1, topk_indices, topk_probs)
+
+def build_rope(head_dim, length, device=None):
+    """cos and sin of the rotary embedding angles of positions [0, length), each (length, head_dim // 2)."""
+    inv_freq = 1.0 / (10000 ** (torch.arange(0, head_dim, 2, dtype=torch.float32, device=device) / head_dim))
+    freqs = torch.outer(torch.arange(length, dtype=torch.float32, device=device), inv_freq)
+    return freqs.cos(), freqs.sin()
+
+def apply_rope(x, cos, sin):
+    """
+    Rotates q or k (B, H, T, head_dim) by the half-width cos/sin tables, i.e.
+    x * cat(cos, cos) + cat(-x[..., 1::2], x[..., ::2]) * cat(sin, sin), but written straight
+    into one output tensor instead of materializing the concatenations and the negation.
+    """
+    half = x.size(-1) // 2
+    out = (x.unflatten(-1, (2, half)) * cos.unsqueeze(-2)).flatten(-2)
+    halves = out.unflatten(-1, (2, half))
+    halves[..., 0, :].addcmul_(x[..., 1::2], sin, value=-1)
+    halves[..., 1, :].addcmul_(x[..., ::2], sin)
+    return out
+
+def chunked_cross_entropy(x, weight, targets, chunk_size, with_grads=False):
+    """
+    Mean cross-entropy of the logits x @ weight.T against targets (-100 is ignored, as in
+    F.cross_entropy), computed `chunk_size` rows at a time so only one chunk of logits exists
+    at once. With `with_grads` the gradients with respect to x and weight are also returned.
+    """
+    x, targets = x.reshape(-1, x.size(-1)), targets.reshape(-1)
+    valid = targets != -100
+    safe_targets = targets.masked_fill(~valid, 0)
+    num_valid = valid.sum()
+    loss = torch.zeros((), dtype=torch.float32, device=x.device)
+    grad_x = torch.empty_like(x) if with_grads else None
+    grad_weight = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device) if with_grads else None
+    for i in range(0, x.size(0), chunk_size):
+        x_c, t_c, v_c = x[i:i + chunk_size], safe_targets[i:i + chunk_size, None], valid[i:i + chunk_size]
+        logits = F.linear(x_c, weight)  # (chunk_size, vocab_size), in the autocast dtype if any
+        logits_f = logits.float()  # the loss itself is always computed in fp32, as F.cross_entropy does under autocast
+        lse = torch.logsumexp(logits_f, dim=-1, keepdim=True)
+        loss += ((lse - logits_f.gather(1, t_c)).squeeze(1) * v_c).sum()
+        if with_grads:
+            # d loss / d logits = (softmax - one_hot) / num_valid, on the valid rows only
+            grad_logits = logits_f.sub(lse).exp_().scatter_add_(1, t_c, torch.full_like(lse, -1.0))
+            grad_logits = grad_logits.mul_(v_c[:, None] / num_valid).to(logits.dtype)
+            grad_x[i:i + chunk_size] = grad_logits @ weight.to(logits.dtype)
+            grad_weight += grad_logits.t() @ x_c.to(logits.dtype)
+    loss = loss / num_valid
+    if with_grads:
+        return loss, grad_x, grad_weight.to(weight.dtype)
+    return loss
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    Autograd wrapper of chunked_cross_entropy for training: each chunk's gradients are taken
+    while its logits exist in forward, backward only scales them by the incoming gradient,
+    so the full (B * T, vocab_size) logits are never built and nothing is recomputed.
+    """
+    @staticmethod
+    def forward(ctx, x, weight, targets, chunk_size):
+        loss, grad_x, grad_weight = chunked_cross_entropy(x, weight, targets, chunk_size, with_grads=True)
+        ctx.save_for_backward(grad_x.view_as(x), grad_weight)
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        grad_x, grad_weight = ctx.saved_tensors
+        return grad_x * grad_loss, grad_weight * grad_loss, None, None
 
 class LoRALayer(nn.Module):
     def __init__(self, in_features: int, out_features: int, r: int = 8, alpha: float = 1.0):
@@ -22,67 +104,81 @@ class LoRALayer(nn.Module):
         return torch.matmul(x, self.lora_A).matmul(self.lora_B) * self.scaling
 
 class CausalSelfAttention(nn.Module):
-    def __init__(self, config, use_lora=False, lora_r=8, lora_alpha=1.0):
+    def __init__(self, config, layer_idx=0, use_lora=False, lora_r=8, lora_alpha=1.0):
         super().__init__()
         assert config.n_embd % config.n_head == 0  # Ensure that embedding dimension is divisible by the number of heads
+        n_kv_head = config.n_kv_head or config.n_head
+        assert config.n_head % n_kv_head == 0, "n_head must be a multiple of n_kv_head"
         self.use_lora = use_lora
-        
-        # Linear layers for Q, K, V projections, and output projection
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd)
-        self.c_proj = nn.Linear(config.n_embd, config.n_embd)
-
-        if self.use_lora:
-            self.lora_q = LoRALayer(config.n_embd, config.n_embd, r=lora_r, alpha=lora_alpha)
-            self.lora_k = LoRALayer(config.n_embd, config.n_embd, r=lora_r, alpha=lora_alpha)
+        self.layer_idx = layer_idx  # Index of this layer's slot in the KV cache
 
         # Attention parameters
         self.n_head = config.n_head  # Number of attention heads
+        self.n_kv_head = n_kv_head  # Number of key/value heads, each shared by n_head // n_kv_head query heads
         self.n_embd = config.n_embd  # Embedding dimension
         self.head_dim = config.n_embd // config.n_head  # Dimension per head
+        self.kv_dim = n_kv_head * self.head_dim  # Width of the keys and of the values
+        
+        # Linear layers for Q, K, V projections, and output projection
+        self.c_attn = nn.Linear(config.n_embd, config.n_embd + 2 * self.kv_dim)
+        self.c_proj = nn.Linear(config.n_embd, config.n_embd)
 
-        # Cache for key and value tensors for inference
-        self.register_buffer("cache_k", None)
-        self.register_buffer("cache_v", None)
-
-        # Rotary positional embedding (RoPE) frequency matrix
-        inv_freq = 1.0 / (10000 ** (torch.arange(0, self.head_dim, 2, dtype=torch.float32) / self.head_dim))
-        self.register_buffer("inv_freq", inv_freq)
+        if self.use_lora:
+            self.lora_q = LoRALayer(config.n_embd, config.n_embd, r=lora_r, alpha=lora_alpha)
+            self.lora_k = LoRALayer(self.kv_dim, self.kv_dim, r=lora_r, alpha=lora_alpha)
 
-        # RoPE cache (precomputed embeddings for longer sequences)
-        self.cached_seq_len = None
-        self.cached_cos_sin = None
-    
-    def clear_cache(self):
-        self.cache_k = None
-        self.cache_v = None
-    
-    def rotate_half(self, x):
-        x1, x2 = x[..., ::2], x[..., 1::2]  # Split even and odd dimensions
-        return torch.cat((-x2, x1), dim=-1)  # Rotate halves and concatenate
+        # Named LoRA adapters for serving: name -> (A_q, B_q, A_k, B_k, scaling), kept out of the state dict
+        self.adapters = {}
     
-    def apply_rotary_pos_emb(self, q, k, cos, sin):
-        q_rot = q * cos + self.rotate_half(q) * sin  # Apply RoPE to query
-        k_rot = k * cos + self.rotate_half(k) * sin  # Apply RoPE to key
-        return q_rot, k_rot
-
-    def compute_rope(self, seq_len, device):
-        """Computes RoPE dynamically, or retrieves from cache."""
-        if self.cached_seq_len is None or self.cached_seq_len < seq_len:
-            t = torch.arange(seq_len, dtype=torch.float32, device=device)
-            freqs = torch.einsum('i,j->ij', t, self.inv_freq)
-            emb = torch.cat((freqs, freqs), dim=-1)
-            cos = emb.cos().unsqueeze(0).unsqueeze(0)
-            sin = emb.sin().unsqueeze(0).unsqueeze(0)
-            self.cached_seq_len = seq_len
-            self.cached_cos_sin = (cos, sin)
-        return self.cached_cos_sin
+    def apply_adapters(self, q, k, names, rows):
+        """Adds a different LoRA adapter to every row of q and k: `rows` indexes into `names`, shifted by one, 0 means none."""
+        C, KV = self.n_embd, self.kv_dim
+        r = max(self.adapters[n][0].size(1) for n in names)
+        # stack the adapters used in this batch, zero-padded to a common rank, with an all-zero adapter at index 0
+        kw = dict(device=q.device, dtype=q.dtype)
+        A_q, B_q = torch.zeros(len(names) + 1, C, r, **kw), torch.zeros(len(names) + 1, r, C, **kw)
+        A_k, B_k = torch.zeros(len(names) + 1, KV, r, **kw), torch.zeros(len(names) + 1, r, KV, **kw)
+        for i, n in enumerate(names, start=1):
+            a_q, b_q, a_k, b_k, scaling = self.adapters[n]
+            A_q[i, :, :a_q.size(1)], B_q[i, :b_q.size(0)] = a_q, b_q * scaling
+            A_k[i, :, :a_k.size(1)], B_k[i, :b_k.size(0)] = a_k, b_k * scaling
+        q = q + torch.bmm(torch.bmm(q, A_q[rows]), B_q[rows])
+        k = k + torch.bmm(torch.bmm(k, A_k[rows]), B_k[rows])
+        return q, k
+
+    @torch.no_grad()
+    def merge_adapter(self, name, unmerge=False):
+        """
+        Folds the named adapter into the c_attn weights, or takes it back out with unmerge=True.
+        The adapter maps q -> q (I + s A B), which is linear, so the q rows of c_attn become
+        (I + s A B)^T W_q (same for k and the biases). The inverse comes from the Woodbury
+        identity, (I + s A B)^-1 = I - s A (I + s B A)^-1 B, so unmerging needs no weight copy.
+        """
+        assert isinstance(self.c_attn, nn.Linear), "adapters can only be merged into floating point weights"
+        A_q, B_q, A_k, B_k, scaling = self.adapters[name]
+        for offset, width, A, B in ((0, self.n_embd, A_q, B_q), (self.n_embd, self.kv_dim, A_k, B_k)):
+            A, B = A.double(), B.double() * scaling
+            eye = torch.eye(width, dtype=torch.float64, device=A.device)
+            if unmerge:
+                M = eye - A @ torch.linalg.inv(torch.eye(A.size(1), dtype=torch.float64, device=A.device) + B @ A) @ B
+            else:
+                M = eye + A @ B
+            W = self.c_attn.weight[offset:offset + width]
+            W.copy_(M.T @ W.double())
+            if self.c_attn.bias is not None:
+                b = self.c_attn.bias[offset:offset + width]
+                b.copy_(M.T @ b.double())
     
-    def forward(self, x, use_cache=False):
+    def forward(self, x, rope, kv_cache=None, start_pos=0, adapters=None):
+        # rope is the (cos, sin) of this forward's positions, sliced from the table GPT shares across layers
         B, T, C = x.size()  # Batch size, sequence length, embedding size
 
         # Get QKV projections from the input
         qkv = self.c_attn(x)
-        q, k, v = qkv.chunk(3, dim=2)
+        q, k, v = qkv.split([self.n_embd, self.kv_dim, self.kv_dim], dim=2)
+
+        if adapters is not None:
+            q, k = self.apply_adapters(q, k, *adapters)  # a per-row choice of loaded LoRA adapter
 
         if self.use_lora:
             q = q + self.lora_q(q)  # LoRA applied to query
@@ -90,21 +186,34 @@ class CausalSelfAttention(nn.Module):
 
         # Reshape for multi-head attention
         q = q.view(B, T, self.n_head, self.head_dim).transpose(1, 2)
-        k = k.view(B, T, self.n_head, self.head_dim).transpose(1, 2)
-        v = v.view(B, T, self.n_head, self.head_dim).transpose(1, 2)
+        k = k.view(B, T, self.n_kv_head, self.head_dim).transpose(1, 2)
+        v = v.view(B, T, self.n_kv_head, self.head_dim).transpose(1, 2)
 
-        # Compute rotary positional embeddings (RoPE)
-        cos, sin = self.compute_rope(seq_len=T, device=x.device)
-        q, k = self.apply_rotary_pos_emb(q, k, cos, sin)
+        # Rotary positional embeddings (RoPE)
+        cos, sin = rope
+        q = apply_rope(q, cos, sin)
+        if kv_cache is None or not kv_cache.rotates_keys:  # a streaming cache rotates keys by their slot itself
+            k = apply_rope(k, cos, sin)
 
-        if use_cache and self.cache_k is not None:
-            k = torch.cat((self.cache_k, k), dim=2)
-            v = torch.cat((self.cache_v, v), dim=2)
-        if use_cache:
-            self.cache_k = k
-            self.cache_v = v
+        attn_mask, is_causal = None, True
+        if kv_cache is not None:
+            # Write the new keys/values in place and attend over everything cached so far
+            k, v = kv_cache.update(self.layer_idx, k, v, start_pos)
+            k, v = k.to(q.dtype), v.to(q.dtype)  # the cache keeps the model's dtype, autocast may compute in another
+            if torch.is_tensor(start_pos):
+                # every row sits at its own position, so mask out the keys past each row's queries
+                q_pos = start_pos[:, None] + torch.arange(T, device=x.device)  # (B, T)
+                attn_mask = (torch.arange(k.size(2), device=x.device) <= q_pos[..., None]).unsqueeze(1)  # (B, 1, T, S)
+                is_causal = False
+            elif T == 1:
+                is_causal = False  # a single new token may attend to every cached position
+            elif start_pos > 0:
+                # queries sit at positions [start_pos, start_pos + T), keys at [0, start_pos + T)
+                attn_mask = torch.ones(T, start_pos + T, dtype=torch.bool, device=x.device).tril(diagonal=start_pos)
+                is_causal = False
 
-        y = F.scaled_dot_product_attention(q, k, v, attn_mask=None, is_causal=True)
+        # with fewer key/value heads each one serves a group of query heads, without being repeated in memory
+        y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, is_causal=is_causal, enable_gqa=self.n_kv_head != self.n_head)
         y = y.transpose(1, 2).contiguous().view(B, T, C)
 
         y = self.c_proj(y)
@@ -127,17 +236,31 @@ class MLP(nn.Module):
 
 class Block(nn.Module):
 
-    def __init__(self, config, use_lora=False, lora_r=8, lora_alpha=1.0):
+    def __init__(self, config, layer_idx=0, use_lora=False, lora_r=8, lora_alpha=1.0):
         super().__init__()
         self.ln_1 = nn.LayerNorm(config.n_embd)
-        self.attn = CausalSelfAttention(config, use_lora=use_lora, lora_r=lora_r, lora_alpha=lora_alpha)
+        self.attn = CausalSelfAttention(config, layer_idx=layer_idx, use_lora=use_lora, lora_r=lora_r, lora_alpha=lora_alpha)
         self.ln_2 = nn.LayerNorm(config.n_embd)
         self.mlp = MLP(config)
+        # activation checkpointing: None, "block" (recompute the whole block) or "mlp" (recompute only the MLP)
+        self.checkpoint = None
 
-    def forward(self, x, use_cache=False):
-        x = x + self.attn(self.ln_1(x), use_cache=use_cache)
-        x = x + self.mlp(self.ln_2(x))
-        return x
+    def _mlp(self, x):
+        return self.mlp(self.ln_2(x))
+
+    def _forward(self, x, rope, kv_cache=None, start_pos=0, adapters=None, checkpoint_mlp=False):
+        x = x + self.attn(self.ln_1(x), rope, kv_cache=kv_cache, start_pos=start_pos, adapters=adapters)
+        if checkpoint_mlp:
+            # the MLP holds the largest activations (4 * n_embd wide) and is cheap to run again
+            return x + torch.utils.checkpoint.checkpoint(self._mlp, x, use_reentrant=False)
+        return x + self._mlp(x)
+
+    def forward(self, x, rope, kv_cache=None, start_pos=0, adapters=None):
+        # activations are only dropped when training with autograd, decoding with a KV cache is never recomputed
+        recompute = self.checkpoint is not None and self.training and torch.is_grad_enabled() and kv_cache is None
+        if recompute and self.checkpoint == "block":
+            return torch.utils.checkpoint.checkpoint(self._forward, x, rope, None, start_pos, adapters, use_reentrant=False)
+        return self._forward(x, rope, kv_cache=kv_cache, start_pos=start_pos, adapters=adapters, checkpoint_mlp=recompute)
 
 @dataclass
 class GPTConfig:
@@ -146,6 +269,13 @@ class GPTConfig:
     n_layer: int = 12
     n_head: int = 12
     n_embd: int = 768
+    n_kv_head: int = None  # key/value heads for grouped-query attention (1 is multi-query), None means n_head
+    # activation checkpointing, trades compute for memory in training: "none", "block" or "mlp" (selective)
+    checkpoint_activations: str = "none"
+    checkpoint_every: int = 1  # checkpoint every k-th block, starting with the first
+    # with targets, compute the lm_head and cross-entropy this many tokens at a time instead of building
+    # the full (B, T, vocab_size) logits (forward then returns no logits), 0 materializes them as usual
+    loss_chunk_size: int = 0
 
 class GPT(nn.Module):
     def __init__(self, config, use_lora=False, lora_r=8, lora_alpha=1.0):
@@ -155,7 +285,7 @@ class GPT(nn.Module):
         self.transformer = nn.ModuleDict(dict(
             wte = nn.Embedding(config.vocab_size, config.n_embd), # Token embedding
             wpe = nn.Embedding(config.block_size, config.n_embd), # Position embedding
-            h = nn.ModuleList([Block(config, use_lora=use_lora, lora_r=lora_r, lora_alpha=lora_alpha) for _ in range(config.n_layer)]), # Transformer blocks
+            h = nn.ModuleList([Block(config, layer_idx=i, use_lora=use_lora, lora_r=lora_r, lora_alpha=lora_alpha) for i in range(config.n_layer)]), # Transformer blocks
             ln_f = nn.LayerNorm(config.n_embd), # Final layer norm
         ))
         
@@ -163,9 +293,25 @@ class GPT(nn.Module):
         
         # Weight sharing scheme
         self.transformer.wte.weight = self.lm_head.weight
+
+        # One rotary embedding table for all layers, indexed by absolute position (not saved, it is rebuilt from the config)
+        self.head_dim = config.n_embd // config.n_head
+        rope_cos, rope_sin = build_rope(self.head_dim, config.block_size)
+        self.register_buffer("rope_cos", rope_cos, persistent=False)
+        self.register_buffer("rope_sin", rope_sin, persistent=False)
+        self._register_load_state_dict_pre_hook(self._drop_legacy_rope)
+
+        # Activation checkpointing: mark every checkpoint_every-th block to recompute its activations in backward
+        assert config.checkpoint_activations in ("none", "block", "mlp"), f"unknown checkpoint_activations {config.checkpoint_activations}"
+        if config.checkpoint_activations != "none":
+            for block in self.transformer.h[::config.checkpoint_every]:
+                block.checkpoint = config.checkpoint_activations
         
         # Initialize parameters
         self.apply(self._init_weights)
+
+        # Name of the LoRA adapter currently folded into the c_attn weights, if any
+        self.merged_adapter = None
     
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
@@ -178,22 +324,50 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
             
-    def forward(self, idx, targets=None, use_cache=False):
+    def forward(self, idx, targets=None, kv_cache=None, start_pos=0, adapters=None, logit_positions=None):
+        # logit_positions limits the lm_head to some positions: an int (e.g. -1 for the last), a slice,
+        # or a (B,) tensor of one position per row, the logits then have shape (B, T', vocab_size)
         _, T = idx.size()
-        assert T <= self.config.block_size, f"Cannot forward sequence of length {T}, block size is only {self.config.block_size}"
+        # start_pos is either a single offset for the whole batch or a (B,) tensor of per-row offsets
+        if not (torch.is_tensor(start_pos) and torch.compiler.is_compiling()):  # reading a tensor offset would sync and break the graph
+            max_len = (int(start_pos.max()) if torch.is_tensor(start_pos) else start_pos) + T
+            assert max_len <= self.config.block_size, f"Cannot forward sequence of length {max_len}, block size is only {self.config.block_size}"
         
         # Forward the token and posisition embeddings
-        pos = torch.arange(0, T, dtype=torch.long, device=idx.device) # Position indices
-        pos_emb = self.transformer.wpe(pos) # Position embeddings of shape (T, n_embd)
+        pos = torch.arange(T, dtype=torch.long, device=idx.device) # Position indices
+        pos = start_pos[:, None] + pos if torch.is_tensor(start_pos) else pos + start_pos
+        pos_emb = self.transformer.wpe(pos) # Position embeddings of shape (T, n_embd) or (B, T, n_embd)
         tok_emb = self.transformer.wte(idx) # Token embeddings of shape (B, T, n_embd)
         x = tok_emb + pos_emb
+
+        # adapters is one loaded adapter name (or None) per row, resolve it to indices once for all layers
+        if adapters is not None:
+            assert self.merged_adapter is None, "unmerge the merged adapter before running per-row adapters"
+            names = sorted({n for n in adapters if n is not None})
+            rows = torch.tensor([0 if n is None else names.index(n) + 1 for n in adapters], device=idx.device)
+            adapters = (names, rows) if names else None
         
-        # Forward the blocks of the transformer
+        # Forward the blocks of the transformer, all sharing the RoPE rows of these positions
+        rope = self.rope(T, start_pos)
         for block in self.transformer.h:
-            x = block(x, use_cache=use_cache)
+            x = block(x, rope, kv_cache=kv_cache, start_pos=start_pos, adapters=adapters)
             
         # Forward the final layernorm and the classifier
         x = self.transformer.ln_f(x)
+        if targets is not None and self.config.loss_chunk_size and isinstance(self.lm_head, nn.Linear):
+            # the loss straight from the hidden states, one chunk of logits at a time
+            weight = self.lm_head.weight
+            if torch.is_grad_enabled() and (x.requires_grad or weight.requires_grad):
+                return None, ChunkedCrossEntropy.apply(x, weight, targets, self.config.loss_chunk_size)
+            return None, chunked_cross_entropy(x, weight, targets, self.config.loss_chunk_size)
+        if logit_positions is not None:
+            assert targets is None, "the loss needs the logits of every position"
+            if torch.is_tensor(logit_positions):
+                x = x[torch.arange(x.size(0), device=x.device), logit_positions].unsqueeze(1)
+            elif isinstance(logit_positions, int):
+                x = x[:, logit_positions:logit_positions + 1 or None]
+            else:
+                x = x[:, logit_positions]
         logits = self.lm_head(x) # (B, T, vocab_size)
         
         loss = None
@@ -201,7 +375,30 @@ class GPT(nn.Module):
             loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
         return logits, loss
     
-    def configure_optimizers(self, weight_decay, learning_rate):
+    @staticmethod
+    def _drop_legacy_rope(state_dict, prefix, *args):
+        # checkpoints from before the shared table carry a per-layer inv_freq buffer, it is the same for every layer
+        for key in [k for k in state_dict if k.startswith(prefix) and k.endswith(".attn.inv_freq")]:
+            del state_dict[key]
+
+    def rope(self, T, start_pos=0):
+        """
+        cos/sin rows of the shared RoPE table for positions [start_pos, start_pos + T): views of
+        shape (T, head_dim // 2), or (B, 1, T, head_dim // 2) gathered for a (B,) tensor of offsets.
+        """
+        if torch.is_tensor(start_pos):
+            pos = start_pos[:, None] + torch.arange(T, device=start_pos.device)  # (B, T)
+            return self.rope_cos[pos].unsqueeze(1), self.rope_sin[pos].unsqueeze(1)
+        if start_pos + T > self.rope_cos.size(0):
+            self.extend_rope(start_pos + T)
+        return self.rope_cos[start_pos:start_pos + T], self.rope_sin[start_pos:start_pos + T]
+
+    def extend_rope(self, length):
+        """Rebuilds the shared RoPE table to cover `length` positions, e.g. after growing the block size."""
+        cos, sin = build_rope(self.head_dim, length, device=self.rope_cos.device)
+        self.rope_cos, self.rope_sin = cos.to(self.rope_cos.dtype), sin.to(self.rope_sin.dtype)
+
+    def configure_optimizers(self, weight_decay, learning_rate, zero=False):
         # start with all of the candidate parameters (that require grad)
         param_dict = {pn: p for pn, p in self.named_parameters() if p.requires_grad}
         
@@ -218,12 +415,272 @@ class GPT(nn.Module):
         print(f"Model size: {num_decay_params + num_nodecay_params}")
         
         # Create AdamW optimizer
+        if zero:
+            # ZeRO stage 1: every rank keeps the AdamW state of its own share of the parameters only,
+            # steps that share and broadcasts the updated parameters to the other ranks
+            from torch.distributed.optim import ZeroRedundancyOptimizer
+            return ZeroRedundancyOptimizer(optim_groups, optimizer_class=torch.optim.AdamW, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=True)
         optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=(0.9, 0.95), eps=1e-8, fused=True)
         return optimizer
     
-    def generate(self, prompt, max_length=32, num_return_sequences=1, top_k=50, device='cpu'):
+    def save_adapter(self, path):
+        """Saves the trained LoRA layers of a model built with use_lora=True as a standalone adapter file."""
+        blocks = self.transformer.h
+        assert blocks[0].attn.use_lora, "the model has no LoRA layers to save"
+        layers = [{
+            'q_A': b.attn.lora_q.lora_A.detach().cpu(), 'q_B': b.attn.lora_q.lora_B.detach().cpu(),
+            'k_A': b.attn.lora_k.lora_A.detach().cpu(), 'k_B': b.attn.lora_k.lora_B.detach().cpu(),
+        } for b in blocks]
+        torch.save({'r': blocks[0].attn.lora_q.r, 'alpha': blocks[0].attn.lora_q.alpha, 'layers': layers}, path)
+
+    def load_adapter(self, name, path):
+        """Loads an adapter file written by save_adapter under `name`, ready to be merged or used per row."""
+        adapter = torch.load(path, map_location='cpu')
+        assert len(adapter['layers']) == self.config.n_layer, "adapter was trained for a different number of layers"
+        param = self.transformer.wpe.weight
+        scaling = adapter['alpha'] / adapter['r']
+        for block, layer in zip(self.transformer.h, adapter['layers']):
+            A_q, B_q, A_k, B_k = (layer[key].to(device=param.device, dtype=param.dtype) for key in ('q_A', 'q_B', 'k_A', 'k_B'))
+            block.attn.adapters[name] = (A_q, B_q, A_k, B_k, scaling)
+
+    def unload_adapter(self, name):
+        if self.merged_adapter == name:
+            self.unmerge_adapter()
+        for block in self.transformer.h:
+            del block.attn.adapters[name]
+
+    def merge_adapter(self, name):
+        """Folds a loaded adapter into the c_attn weights, so inference runs without any LoRA overhead."""
+        if self.merged_adapter == name:
+            return
+        if self.merged_adapter is not None:
+            self.unmerge_adapter()
+        for block in self.transformer.h:
+            block.attn.merge_adapter(name)
+        self.merged_adapter = name
+
+    def unmerge_adapter(self):
+        """Restores the base c_attn weights."""
+        if self.merged_adapter is None:
+            return
+        for block in self.transformer.h:
+            block.attn.merge_adapter(self.merged_adapter, unmerge=True)
+        self.merged_adapter = None
+
+    def init_kv_cache(self, batch_size, max_len=None, static=False):
+        """Allocates a KV cache for `batch_size` sequences of up to `max_len` tokens."""
+        max_len = min(max_len or self.config.block_size, self.config.block_size)
+        param = self.transformer.wpe.weight  # never quantized, so always a floating point parameter
+        head_dim = self.config.n_embd // self.config.n_head
+        # only the key/value heads are cached, n_kv_head / n_head of the multi-head size
+        return KVCache(self.config.n_layer, batch_size, self.config.n_kv_head or self.config.n_head, max_len, head_dim, device=param.device, dtype=param.dtype, static=static)
+
+    def init_paged_kv_cache(self, max_bytes, block_len=16):
+        """Allocates a paged KV cache shared by all layers that never uses more than `max_bytes`."""
+        param = self.transformer.wpe.weight
+        head_dim = self.config.n_embd // self.config.n_head
+        return PagedKVCache(self.config.n_layer, self.config.n_kv_head or self.config.n_head, head_dim, max_bytes, block_len=block_len, device=param.device, dtype=param.dtype)
+
+    def init_sink_kv_cache(self, batch_size, num_sinks=4, window=None):
+        """Allocates a fixed-size streaming cache: `num_sinks` attention sinks plus a rolling window of recent tokens."""
+        window = window or self.config.block_size - num_sinks
+        assert num_sinks + window <= self.config.block_size, f"{num_sinks} sinks + window {window} exceed the block size {self.config.block_size}"
+        param = self.transformer.wpe.weight
+        head_dim = self.config.n_embd // self.config.n_head
+        return SinkKVCache(self.config.n_layer, batch_size, self.config.n_kv_head or self.config.n_head, num_sinks, window, head_dim, (self.rope_cos, self.rope_sin), device=param.device, dtype=param.dtype)
+
+    @torch.no_grad()
+    def generate_stream(self, idx, max_new_tokens=None, top_k=50, num_sinks=4, window=None):
+        """
+        Yields sampled token columns (B, 1) continuing `idx` (B, T), without a length limit when
+        max_new_tokens is None. Runs on a SinkKVCache, so memory and per-token cost stay constant;
+        a prompt longer than the window fills it in one go and then continues in chunks of a quarter
+        window, so every position still attends to at least three quarters of a window of history.
+        """
+        self.eval()
+        kv_cache = self.init_sink_kv_cache(idx.size(0), num_sinks, window)
+        step = max(1, kv_cache.window // 4)
+        chunks = [idx[:, :kv_cache.window]] + list(idx[:, kv_cache.window:].split(step, dim=1))
+        for chunk in chunks:
+            logits, _ = self(chunk, kv_cache=kv_cache, start_pos=kv_cache.make_room(chunk.size(1)), logit_positions=-1)
+        num_generated = 0
+        while True:
+            probs = F.softmax(logits[:, -1, :], dim=-1)
+            topk_probs, topk_indices = torch.topk(probs, top_k, dim=-1)
+            xcol = torch.gather(topk_indices, -1, torch.multinomial(topk_probs, 1))
+            yield xcol
+            num_generated += 1
+            if max_new_tokens is not None and num_generated >= max_new_tokens:
+                return
+            logits, _ = self(xcol, kv_cache=kv_cache, start_pos=kv_cache.make_room(1))
+
+    @torch.no_grad()
+    def score_continuations(self, contexts, continuations):
+        """
+        Log-likelihood scoring for multiple choice. `contexts` is a list of token lists and
+        `continuations[i]` the list of candidate token lists for `contexts[i]`. Every context
+        is run through the model once and all of its candidates are scored on top of its
+        cached keys/values instead of recomputing the context for each candidate.
+
+        Returns (sum_loss, avg_loss), each of shape (total number of candidates,) in input
+        order: the summed cross-entropy of the candidate tokens and that sum divided by the
+        candidate length.
+        """
+        device = self.transformer.wpe.weight.device
+        ctx_lens = [len(c) for c in contexts]
+        assert min(ctx_lens) > 0, "every context needs at least one token"
+        group_sizes = [len(cands) for cands in continuations]
+        flat = [cand for cands in continuations for cand in cands]
+        cand_lens = torch.tensor([len(c) for c in flat], device=device)
+        max_ctx, max_cand = max(ctx_lens), max(len(c) for c in flat)
+
+        # run each context once into the first cache row of its group, then copy it to the group's other rows
+        kv_cache = self.init_kv_cache(len(flat), max_ctx + max_cand)
+        first_rows = torch.tensor([sum(group_sizes[:i]) for i in range(len(contexts))], device=device)
+        ctx = torch.zeros((len(contexts), max_ctx), dtype=torch.long, device=device)
+        for i, c in enumerate(contexts):
+            ctx[i, :len(c)] = torch.tensor(c)
+        # only the last context position predicts a candidate token
+        ctx_last = torch.tensor(ctx_lens, device=device) - 1
+        ctx_logits, _ = self(ctx, kv_cache=kv_cache.select(first_rows), logit_positions=ctx_last)
+        group = torch.repeat_interleave(torch.arange(len(contexts), device=device), torch.tensor(group_sizes, device=device))
+        kv_cache.copy_rows(first_rows[group], torch.arange(len(flat), device=device), max_ctx)
+
+        # all candidates in one forward, each starting right after its own context
+        cands = torch.zeros((len(flat), max_cand), dtype=torch.long, device=device)
+        for i, c in enumerate(flat):
+            cands[i, :len(c)] = torch.tensor(c)
+        ctx_lens = torch.tensor(ctx_lens, device=device)[group]
+        cand_logits, _ = self(cands, kv_cache=kv_cache, start_pos=ctx_lens, logit_positions=slice(None, -1))
+
+        # the first candidate token is predicted by the last context position, the rest by the candidate itself
+        logits = torch.cat((ctx_logits[group], cand_logits), dim=1).float()
+        losses = F.cross_entropy(logits.reshape(-1, logits.size(-1)), cands.view(-1), reduction='none').view(len(flat), -1)
+        mask = torch.arange(max_cand, device=device) < cand_lens[:, None]
+        sum_loss = (losses * mask).sum(dim=1)
+        return sum_loss, sum_loss / cand_lens
+
+    def _speculative_decode(self, draft_model, xgen, next_logits, kv_cache, max_length, top_k, num_draft_tokens):
+        """
+        Yields sampled token columns (B, 1) using `draft_model` to propose `num_draft_tokens`
+        tokens at a time, which this model then verifies in a single forward.
+
+        Proposals are accepted with probability min(1, p/q) and the first rejected one is
+        resampled from the residual max(p - q, 0), so the output follows top-k sampling from
+        this model alone. All rows advance by the smallest number of accepted tokens in the
+        batch (plus one), dropping any further accepted proposals of the other rows.
+        Rejected positions are rolled back by moving the cache positions back, later
+        writes overwrite them.
+        """
+        assert draft_model.config.vocab_size == self.config.vocab_size, "draft model must share the vocabulary"
+        B = xgen.size(0)
+        draft_model.eval()
+        draft_cache = draft_model.init_kv_cache(B, max_length)
+        main_pos, draft_pos = xgen.size(1), 0  # number of valid positions in each cache
+
+        while xgen.size(1) < max_length:
+            L = xgen.size(1)
+            k = min(num_draft_tokens, max_length - L - 1)
+
+            # draft k tokens autoregressively, feeding the draft whatever it hasn't seen yet
+            drafts, q = [], []
+            draft_in = xgen[:, draft_pos:]
+            for i in range(k):
+                draft_logits, _ = draft_model(draft_in, kv_cache=draft_cache, start_pos=L - draft_in.size(1) + i, logit_positions=-1)
+                q.append(top_k_probs(draft_logits[:, -1, :], top_k))
+                draft_in = torch.multinomial(q[-1], 1)
+                drafts.append(draft_in)
+            draft_pos = L + k - 1 if k > 0 else draft_pos
+
+            # verify all proposals with one forward of the main model
+            verify_in = torch.cat([xgen[:, main_pos:]] + drafts, dim=1)
+            logits = [next_logits[:, None, :]] if main_pos == L else []  # the prefill already predicted position L
+            if verify_in.size(1) > 0:
+                out, _ = self(verify_in, kv_cache=kv_cache, start_pos=main_pos)
+                logits.append(out)
+            p = top_k_probs(torch.cat(logits, dim=1), top_k)  # (B, k + 1, vocab_size)
+
+            # accept each proposal with probability min(1, p/q), count the accepted run per row
+            num_accepted = torch.zeros(B, dtype=torch.long, device=xgen.device)
+            if k > 0:
+                d = torch.cat(drafts, dim=1)  # (B, k)
+                q = torch.stack(q, dim=1)  # (B, k, vocab_size)
+                p_d = p[:, :k].gather(-1, d[..., None]).squeeze(-1)
+                q_d = q.gather(-1, d[..., None]).squeeze(-1)
+                accepted = torch.rand_like(p_d) < p_d / q_d
+                num_accepted = accepted.long().cumprod(dim=1).sum(dim=1)
+            m = int(num_accepted.min())
+
+            # rows rejected at position m resample from the residual, the others keep their accepted proposal
+            if m < k:
+                residual = (p[:, m] - q[:, m]).clamp(min=0)
+                residual_sum = residual.sum(dim=-1, keepdim=True)
+                residual = torch.where(residual_sum > 0, residual / residual_sum.clamp(min=1e-12), p[:, m])
+                xcol = torch.where((num_accepted > m)[:, None], drafts[m], torch.multinomial(residual, 1))
+            else:
+                xcol = torch.multinomial(p[:, k], 1)  # every proposal accepted, sample the bonus token
+            new_tokens = drafts[:m] + [xcol]
+
+            # roll both caches back to the accepted prefix
+            main_pos = L + m
+            draft_pos = min(draft_pos, L + m)
+            for xcol in new_tokens:
+                xgen = torch.cat((xgen, xcol), dim=1)
+                yield xcol
+
+    @torch.no_grad()
+    def _token_stream(self, xgen, max_length, top_k=50, prefix_cache=None, draft_model=None, num_draft_tokens=4, compiled=None):
+        """
+        Yields sampled token columns (B, 1) continuing `xgen` (B, T) up to max_length tokens in total.
+        The tokens stay on the device, nothing here waits for the host, and the next forward only
+        runs once the caller asks for the next column.
+        """
+        # Prefill the cache with the whole prompt once, afterwards only the newest token is fed
+        # `compiled` is an optional CompiledGPT of this model, used for the prefill and the decode steps
+        if compiled is not None:
+            # always the compiled cache length, so the warmed up graphs serve every max_length
+            kv_cache = compiled.init_kv_cache(xgen.size(0))
+            assert max_length <= kv_cache.max_len, f"max_length {max_length} exceeds the compiled cache length {kv_cache.max_len}"
+        else:
+            kv_cache = self.init_kv_cache(xgen.size(0), max_length)
+        prefix_len = 0
+        if prefix_cache is not None:
+            # reuse the longest cached prefix, but always prefill at least the last token to get its logits
+            prefix_len = prefix_cache.load(xgen[0].tolist(), kv_cache, max_len=xgen.size(1) - 1)
+        if compiled is not None:
+            logits = compiled.prefill(xgen[:, prefix_len:], kv_cache, start_pos=prefix_len)
+        else:
+            logits, _ = self(xgen[:, prefix_len:], kv_cache=kv_cache, start_pos=prefix_len, logit_positions=-1)  # (B, 1, vocab_size)
+        if prefix_cache is not None:
+            prefix_cache.insert(xgen[0].tolist(), kv_cache)
+
+        if draft_model is not None:
+            # speculative decoding: the draft proposes tokens, this model verifies them in batches
+            yield from self._speculative_decode(draft_model, xgen, logits[:, -1, :], kv_cache, max_length, top_k, num_draft_tokens)
+            return
+
+        length = xgen.size(1)
+        while length < max_length:
+            logits = logits[:, -1, :]  # take the logits at the last position
+            probs = F.softmax(logits, dim=-1)# get the probabilities
+
+            # Top-k sampling
+            topk_probs, topk_indices = torch.topk(probs, top_k, dim=-1)
+            ix = torch.multinomial(topk_probs, 1)  # select a token from the top-k probabilities
+            xcol = torch.gather(topk_indices, -1, ix)  # gather the corresponding indices
+            yield xcol
+            length += 1
+
+            if length < max_length:
+                # forward only the new token, at its absolute position
+                if compiled is not None:
+                    logits = compiled.decode(xcol, kv_cache, length - 1)
+                else:
+                    logits, _ = self(xcol, kv_cache=kv_cache, start_pos=length - 1)
+
+    def generate(self, prompt, max_length=32, num_return_sequences=1, top_k=50, device='cpu', prefix_cache=None, draft_model=None, num_draft_tokens=4, compiled=None):
         self.eval()
-        enc = tiktoken.get_encoding('gpt2')
+        enc = get_enc()
         tokens = enc.encode(prompt)
         tokens = torch.tensor(tokens, dtype=torch.long, device=device)
         tokens = tokens.unsqueeze(0).repeat(num_return_sequences, 1)
@@ -231,29 +688,15 @@ class GPT(nn.Module):
         print(prompt, end="", flush=True)
         xgen = tokens
         
-        with torch.no_grad():
-            # Clear the cache before generating
-            for block in self.transformer.h:
-                block.attn.clear_cache()
-
-            while xgen.size(1) < max_length:
-                # forward the model to get the logits
-                logits, _ = self(xgen, use_cache=True)  # (B, T, vocab_size)
-                logits = logits[:, -1, :]  # take the logits at the last position
-                probs = F.softmax(logits, dim=-1)# get the probabilities
-                
-                # Top-k sampling
-                topk_probs, topk_indices = torch.topk(probs, top_k, dim=-1)
-                ix = torch.multinomial(topk_probs, 1)  # select a token from the top-k probabilities
-                xcol = torch.gather(topk_indices, -1, ix)  # gather the corresponding indices
-                xgen = torch.cat((xgen, xcol), dim=1) # append to the sequence
-                
-                # Decode and print the last generated word
-                last_token = xgen[0, -1].item()
-                last_word = enc.decode([last_token])
-                print(last_word, end="", flush=True)
-                
-                # Check if generated length exceeds 70% of max_length
-                if xgen.size(1) > 0.7 * max_length and (last_word.endswith('.') or last_word.endswith('!') or last_word.endswith('?')):
-                    break
-        print()
\ No newline at end of file
+        for xcol in self._token_stream(xgen, max_length, top_k, prefix_cache, draft_model, num_draft_tokens, compiled):
+            xgen = torch.cat((xgen, xcol), dim=1) # append to the sequence
+            
+            # Decode and print the last generated word
+            last_token = xgen[0, -1].item()
+            last_word = enc.decode([last_token])
+            print(last_word, end="", flush=True)
+            
+            # Check if generated length exceeds 70% of max_length
+            if xgen.size(1) > 0.7 * max_length and (last_word.endswith('.') or last_word.endswith('!') or last_word.endswith('?')):
+                break
+        print()
@@ -0,0 +1,223 @@
+import os
+import math
+import time
+from dataclasses import asdict
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+from model import GPT, GPTConfig
+
+def quantize_int8(weight):
+    # symmetric, one scale per output channel
+    scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+    weight_q = torch.round(weight / scales[:, None]).clamp(-127, 127).to(torch.int8)
+    return weight_q, scales
+
+def quantize_int4(weight, group_size):
+    # symmetric, one scale per group of `group_size` input features, two 4-bit values packed per byte
+    out_features, in_features = weight.shape
+    assert in_features % group_size == 0 and group_size % 2 == 0, "in_features must split into even-sized groups"
+    groups = weight.view(out_features, in_features // group_size, group_size)
+    scales = groups.abs().amax(dim=2).clamp(min=1e-8) / 7
+    q = torch.round(groups / scales[..., None]).clamp(-8, 7).to(torch.int16) + 8  # [0, 15]
+    q = q.view(out_features, in_features).to(torch.uint8)
+    weight_q = q[:, 0::2] | (q[:, 1::2] << 4)
+    return weight_q, scales
+
+def dequantize(weight_q, scales, bits, group_size):
+    # in-place scaling, a broadcasting out-of-place multiply is several times slower on CPU
+    if bits == 8:
+        return weight_q.to(scales.dtype).mul_(scales[:, None])
+    q = torch.empty(*weight_q.shape, 2, dtype=scales.dtype, device=weight_q.device)
+    q[..., 0] = weight_q & 0x0F
+    q[..., 1] = weight_q >> 4
+    q = q.view(weight_q.size(0), -1, group_size).sub_(8).mul_(scales[..., None])
+    return q.view(weight_q.size(0), -1)
+
+class QuantizedLinear(nn.Module):
+    """
+    Weight-only quantized replacement for nn.Linear: weights are stored as int8 (per output channel)
+    or packed int4 (per group of input features), activations stay in floating point.
+
+    On CPU the fused int8/int4 weight-only matmul kernels run on bf16 activations, they are the
+    fastest option for the few rows of a decode step but lose to dequantizing the weights once
+    for large prefills. They run for inputs of at most `fused_max_rows` rows (0 disables them),
+    a fixed rule so the outputs never depend on which path happened to be faster.
+    """
+    fused_max_rows = 16  # measured crossover with a 768x3072 layer is between 16 and 64 rows
+    def __init__(self, in_features, out_features, bias=True, bits=8, group_size=128):
+        super().__init__()
+        assert bits in (8, 4), "only int8 and int4 weights are supported"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        if bits == 8:
+            self.register_buffer("weight_q", torch.zeros(out_features, in_features, dtype=torch.int8))
+            self.register_buffer("scales", torch.ones(out_features))
+        else:
+            self.register_buffer("weight_q", torch.zeros(out_features, in_features // 2, dtype=torch.uint8))
+            self.register_buffer("scales", torch.ones(out_features, in_features // group_size))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+        self._packed = None  # (weight_q version, int4 weights and scales in the layout of the CPU kernel)
+
+    @classmethod
+    def from_linear(cls, linear, bits=8, group_size=128):
+        qlinear = cls(linear.in_features, linear.out_features, bias=linear.bias is not None, bits=bits, group_size=group_size)
+        weight = linear.weight.detach().float()
+        weight_q, scales = quantize_int8(weight) if bits == 8 else quantize_int4(weight, group_size)
+        qlinear.weight_q.copy_(weight_q)
+        qlinear.scales.copy_(scales)
+        if linear.bias is not None:
+            qlinear.bias.copy_(linear.bias.detach())
+        return qlinear.to(linear.weight.device)
+
+    def dequantized_weight(self, dtype=torch.float32):
+        return dequantize(self.weight_q, self.scales.to(dtype), self.bits, self.group_size)
+
+    def _has_fused_kernel(self):
+        if self.bits == 8:
+            return hasattr(torch, "_weight_int8pack_mm")
+        return hasattr(torch.ops.aten, "_weight_int4pack_mm_for_cpu") and self.group_size in (32, 64, 128, 256)
+
+    def _int4_packed(self):
+        # repacked from weight_q on first use and whenever weight_q changes (e.g. load_state_dict)
+        if self._packed is None or self._packed[0] != self.weight_q._version:
+            q = torch.stack((self.weight_q & 0x0F, self.weight_q >> 4), dim=-1).view(self.out_features, -1).to(torch.int32)
+            weight = torch.ops.aten._convert_weight_to_int4pack_for_cpu(q, 1)
+            # the kernel dequantizes (q - 8) * scale + zero, zero is 0 for the symmetric scheme
+            scales = self.scales.t().to(torch.bfloat16)
+            scales_and_zeros = torch.stack((scales, torch.zeros_like(scales)), dim=-1).contiguous()
+            self._packed = (self.weight_q._version, weight, scales_and_zeros)
+        return self._packed[1:]
+
+    def _fused(self, x):
+        x = x.to(torch.bfloat16)
+        if self.bits == 8:
+            return torch._weight_int8pack_mm(x, self.weight_q, self.scales.to(torch.bfloat16))
+        weight, scales_and_zeros = self._int4_packed()
+        return torch.ops.aten._weight_int4pack_mm_for_cpu(x, weight, self.group_size, scales_and_zeros)
+
+    def forward(self, x):
+        x2 = x.reshape(-1, self.in_features)
+        if x2.size(0) == 0:
+            return x.new_zeros(*x.shape[:-1], self.out_features)
+        if x.device.type == "cpu" and x2.size(0) <= self.fused_max_rows and self._has_fused_kernel():
+            # fused weight-only matmul, the weights are never expanded to floating point
+            y = self._fused(x2).to(x.dtype).view(*x.shape[:-1], self.out_features)
+            return y + self.bias if self.bias is not None else y
+        return F.linear(x, self.dequantized_weight(x.dtype), self.bias)
+
+class QuantizedEmbedding(nn.Module):
+    """Token embedding that shares the quantized weights of the tied lm_head, dequantizing only the looked-up rows."""
+    def __init__(self, qlinear):
+        super().__init__()
+        self.bits = qlinear.bits
+        self.group_size = qlinear.group_size
+        # the very same tensors as the lm_head, torch.save stores shared storage only once
+        self.register_buffer("weight_q", qlinear.weight_q)
+        self.register_buffer("scales", qlinear.scales)
+
+    def forward(self, idx):
+        return dequantize(self.weight_q[idx.view(-1)], self.scales[idx.view(-1)], self.bits, self.group_size).view(*idx.shape, -1)
+
+def quantize_model(model, bits=8, group_size=128):
+    """
+    Replaces the nn.Linear layers of every attention and MLP block and the lm_head with
+    QuantizedLinear. The lm_head weight is tied to the token embedding, so the embedding is
+    replaced by a QuantizedEmbedding reading the same quantized weights.
+    """
+    for block in model.transformer.h:
+        for parent in (block.attn, block.mlp):
+            for name, child in list(parent.named_children()):
+                if isinstance(child, nn.Linear):
+                    setattr(parent, name, QuantizedLinear.from_linear(child, bits=bits, group_size=group_size))
+    model.lm_head = QuantizedLinear.from_linear(model.lm_head, bits=bits, group_size=group_size)
+    model.transformer.wte = QuantizedEmbedding(model.lm_head)
+    model.quantization = {'bits': bits, 'group_size': group_size}
+    return model
+
+def save_quantized(model, path):
+    torch.save({'model': model.state_dict(), 'config': asdict(model.config), 'quantization': model.quantization}, path)
+
+def load_quantized(path, device='cpu'):
+    """Rebuilds a quantized GPT from a checkpoint written by save_quantized."""
+    checkpoint = torch.load(path, map_location='cpu')
+    model = GPT(GPTConfig(**checkpoint['config']))
+    quantize_model(model, **checkpoint['quantization'])
+    model.load_state_dict(checkpoint['model'])
+    model.to(device)
+    # moving buffers to another device copies them one module at a time, tie the embedding again
+    model.transformer.wte = QuantizedEmbedding(model.lm_head)
+    return model
+
+def model_bytes(model):
+    tensors = {t.data_ptr(): t for t in list(model.parameters()) + list(model.buffers()) if t is not None}
+    return sum(t.numel() * t.element_size() for t in tensors.values())
+
+@torch.no_grad()
+def perplexity(model, loader, steps=20):
+    model.eval()
+    loader.reset()
+    device = model.transformer.wpe.weight.device
+    loss_accum = 0.0
+    for _ in range(steps):
+        x, y = loader.next_batch()
+        _, loss = model(x.to(device), y.to(device))
+        loss_accum += loss.item() / steps
+    return math.exp(loss_accum)
+
+@torch.no_grad()
+def decode_tokens_per_sec(model, prompt_len=32, new_tokens=64, batch_size=1):
+    """Tokens/sec of cached single-token decode steps after a prompt_len prefill, as GPT.generate runs them."""
+    model.eval()
+    device = model.transformer.wpe.weight.device
+    max_len = min(prompt_len + new_tokens, model.config.block_size)
+    prompt = torch.zeros((batch_size, prompt_len), dtype=torch.long, device=device)
+    token = prompt[:, -1:].contiguous()
+
+    def decode():
+        kv_cache = model.init_kv_cache(batch_size, max_len)
+        model(prompt, kv_cache=kv_cache, logit_positions=-1)
+        t0 = time.perf_counter()
+        for pos in range(prompt_len, max_len):
+            model(token, kv_cache=kv_cache, start_pos=pos)
+        return time.perf_counter() - t0
+
+    decode()  # warmup
+    return batch_size * (max_len - prompt_len) / min(decode() for _ in range(3))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--checkpoint", type=str, default=os.path.join("log", "latest_checkpoint.pt"), help="fp32 checkpoint to quantize")
+    parser.add_argument("-o", "--out", type=str, default=None, help="where to write the quantized checkpoint")
+    parser.add_argument("-b", "--bits", type=int, default=8, choices=[8, 4], help="weight bits")
+    parser.add_argument("-g", "--group_size", type=int, default=128, help="int4 group size")
+    parser.add_argument("--eval_steps", type=int, default=20, help="val batches for the perplexity comparison, 0 to skip")
+    args = parser.parse_args()
+
+    model = GPT(GPTConfig(vocab_size=50304))
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    model.load_state_dict(checkpoint['model'])
+    fp_bytes = model_bytes(model)
+    speed_fp = decode_tokens_per_sec(model)
+
+    ppl_fp = None
+    if args.eval_steps > 0:
+        from dataloader import DataLoader
+        val_loader = DataLoader(B=4, T=1024, split="val")
+        ppl_fp = perplexity(model, val_loader, args.eval_steps)
+
+    quantize_model(model, bits=args.bits, group_size=args.group_size)
+    q_bytes = model_bytes(model)
+    print(f"model size: {fp_bytes / 2**20:.1f} MiB -> {q_bytes / 2**20:.1f} MiB ({fp_bytes / q_bytes:.2f}x smaller)")
+    speed_q = decode_tokens_per_sec(model)
+    print(f"decode speed (cpu, batch 1): {speed_fp:.1f} -> {speed_q:.1f} tok/s ({speed_q / speed_fp:.2f}x)")
+    if ppl_fp is not None:
+        ppl_q = perplexity(model, val_loader, args.eval_steps)
+        print(f"val perplexity: {ppl_fp:.3f} -> {ppl_q:.3f} (delta {ppl_q - ppl_fp:+.3f})")
+
+    out = args.out or os.path.join("log", f"arcane_int{args.bits}.pt")
+    save_quantized(model, out)
+    print(f"wrote {out}")
@@ -0,0 +1,154 @@
+import asyncio
+import codecs
+from dataclasses import dataclass
+import torch
+from model import get_enc
+
+@dataclass
+class StreamChunk:
+    index: int  # which sequence of the batch the text belongs to
+    text: str
+    finish_reason: str = None  # set on the last chunk of a sequence: "stop", "eos" or "length"
+
+class TextStream:
+    """
+    Incremental detokenizer for one sequence.
+
+    Token bytes go through an incremental UTF-8 decoder, so a character split across tokens
+    is only emitted once all of its bytes have arrived. Text that could still turn out to be
+    the start of a stop string is held back until it either completes the stop string (and
+    is dropped with everything after it) or stops matching.
+    """
+    def __init__(self, stop=None, eos_token=None):
+        self.enc = get_enc()
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.stop = [s for s in (stop or []) if s]
+        self.eos_token = eos_token
+        self.tokens = []
+        self.pending = ''  # decoded text not emitted yet
+        self.finish_reason = None
+
+    @property
+    def done(self):
+        return self.finish_reason is not None
+
+    def push(self, tokens):
+        """Feeds new tokens and returns the text that is now final."""
+        if self.done:
+            return ''
+        eos = False
+        for token in tokens:
+            if token == self.eos_token:
+                eos = True
+                break
+            self.tokens.append(token)
+            self.pending += self.decoder.decode(self.enc.decode_single_token_bytes(token))
+
+        hits = [i for i in (self.pending.find(s) for s in self.stop) if i >= 0]
+        if hits:
+            text, self.pending = self.pending[:min(hits)], ''
+            self.finish_reason = "stop"
+            return text
+        if eos:
+            return self.finish("eos")
+
+        # hold back the longest tail that is a prefix of some stop string
+        keep = max([k for s in self.stop for k in range(1, len(s)) if self.pending.endswith(s[:k])], default=0)
+        text, self.pending = self.pending[:len(self.pending) - keep], self.pending[len(self.pending) - keep:]
+        return text
+
+    def finish(self, reason="length"):
+        """Ends the sequence, flushing any held back text and incomplete UTF-8 bytes."""
+        if self.done:
+            return ''
+        text, self.pending = self.pending + self.decoder.decode(b'', final=True), ''
+        self.finish_reason = reason
+        return text
+
+def host_chunks(columns, sync_every=8):
+    """
+    Groups device token columns (B, 1) into host lists of shape (B, n), copying once every
+    `sync_every` tokens instead of once per token. On CUDA the copy of a chunk runs
+    asynchronously into pinned memory and is only read after the next chunk has been
+    sampled, so the device never waits on the host.
+    """
+    in_flight = None  # (pinned host tensor, copy done event)
+    buf = []
+
+    def start_copy(chunk):
+        host = torch.empty(chunk.shape, dtype=chunk.dtype, pin_memory=True)
+        host.copy_(chunk, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        return host, event
+
+    for xcol in columns:
+        buf.append(xcol)
+        if len(buf) < sync_every:
+            continue
+        chunk, buf = torch.cat(buf, dim=1), []
+        if not chunk.is_cuda:
+            yield chunk.tolist()
+            continue
+        previous, in_flight = in_flight, start_copy(chunk)
+        if previous is not None:
+            previous[1].synchronize()
+            yield previous[0].tolist()
+    if in_flight is not None:
+        in_flight[1].synchronize()
+        yield in_flight[0].tolist()
+    if buf:
+        yield torch.cat(buf, dim=1).tolist()
+
+def stream_generate(model, prompt, max_length=32, num_return_sequences=1, top_k=50, stop=None, eos_token="eot",
+                    sync_every=8, device='cpu', num_sinks=4, window=None, **generate_kwargs):
+    """
+    Generates from `prompt` (a string or a list of token ids) and yields StreamChunks of
+    decoded text for each of the `num_return_sequences` sequences as they are produced.
+
+    `eos_token` defaults to the tokenizer's <|endoftext|>, None disables it.
+    `stop` is a list of stop strings shared by all sequences, or one list per sequence.
+    A sequence ends at its first stop string (excluded from the text), at `eos_token`, or
+    at max_length tokens in total, and the generator returns once every sequence has
+    ended. Tokens reach the host `sync_every` at a time, so a finished sequence is only
+    noticed at the next chunk boundary. With max_length=None the stream is unbounded and
+    runs on a rolling window of `window` recent tokens plus `num_sinks` attention sinks
+    (GPT.generate_stream), otherwise the extra keyword arguments go to the usual
+    generation path (prefix_cache, draft_model, compiled...).
+    """
+    model.eval()
+    enc = get_enc()
+    eos_token = enc.eot_token if eos_token == "eot" else eos_token
+    prompt_tokens = enc.encode(prompt) if isinstance(prompt, str) else list(prompt)
+    xgen = torch.tensor(prompt_tokens, dtype=torch.long, device=device).unsqueeze(0).repeat(num_return_sequences, 1)
+    if stop is not None and all(isinstance(s, str) for s in stop):
+        stop = [stop] * num_return_sequences
+    assert stop is None or len(stop) == num_return_sequences, "stop must be shared or given for every sequence"
+    streams = [TextStream(stop[i] if stop else None, eos_token) for i in range(num_return_sequences)]
+
+    if max_length is None:
+        columns = model.generate_stream(xgen, top_k=top_k, num_sinks=num_sinks, window=window)
+    else:
+        columns = model._token_stream(xgen, max_length, top_k, **generate_kwargs)
+    for chunk in host_chunks(columns, sync_every):
+        for i, (stream, tokens) in enumerate(zip(streams, chunk)):
+            if stream.done:
+                continue
+            text = stream.push(tokens)
+            if text or stream.done:
+                yield StreamChunk(i, text, stream.finish_reason)
+        if all(stream.done for stream in streams):
+            return
+    for i, stream in enumerate(streams):
+        if not stream.done:
+            yield StreamChunk(i, stream.finish(), stream.finish_reason)
+
+async def astream_generate(model, prompt, **kwargs):
+    """Async iterator over stream_generate, each chunk of tokens is produced in a worker thread to keep the event loop free."""
+    chunks = stream_generate(model, prompt, **kwargs)
+    done = object()
+    try:
+        while (chunk := await asyncio.to_thread(next, chunks, done)) is not done:
+            yield chunk
+    finally:
+        chunks.close()
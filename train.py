@@ -5,6 +5,10 @@ import os
 from dataloader import DataLoader
 import torch
 from model import GPT, GPTConfig
+from compiled import CompiledGPT
+from checkpoint import CheckpointManager
+from metrics import MetricsLogger, StepProfiler, StepTimer, flops_per_token
+from hellaswag import evaluate_batched
 
 # Learning rate schedule parameters
 max_lr = 6e-4 * 3
@@ -18,14 +22,18 @@ import torch.distributed as dist
 
 ddp = int(os.environ.get('RANK', -1)) != -1 # is this a ddp run?
 if ddp:
-    # use of DDP atm demands CUDA, we set the device appropriately according to rank
-    assert torch.cuda.is_available(), "DDP requires CUDA"
-    init_process_group(backend='nccl')
+    # NCCL with one GPU per rank, or gloo on CPU, e.g. `torchrun --standalone --nproc_per_node=4 train.py` on one box.
+    # DDP_BACKEND=gloo forces the CPU path on a machine with GPUs
+    backend = os.environ.get('DDP_BACKEND', 'nccl' if torch.cuda.is_available() else 'gloo')
+    init_process_group(backend=backend)
     ddp_rank = int(os.environ['RANK'])
     ddp_local_rank = int(os.environ['LOCAL_RANK'])
     ddp_world_size = int(os.environ['WORLD_SIZE'])
-    device = f'cuda:{ddp_local_rank}'
-    torch.cuda.set_device(device)
+    if backend == 'nccl':
+        device = f'cuda:{ddp_local_rank}'
+        torch.cuda.set_device(device)
+    else:
+        device = 'cpu'
     master_process = ddp_rank == 0 # this process will do logging, checkpointing etc.
 else:
     # vanilla, non-DDP run
@@ -44,6 +52,15 @@ else:
 # added after video, pytorch can be serious about it's device vs. device_type distinction
 device_type = "cuda" if device.startswith("cuda") else "cpu"
 
+# Activation checkpointing: "none", "block" (every checkpoint_every-th block) or "mlp" (only the MLPs).
+# Recomputing activations in the backward pass frees memory for a larger B and fewer accumulation steps,
+# `python activation_report.py` shows the memory/speed trade-off of each mode
+checkpoint_activations = "none"
+checkpoint_every = 1
+# lm_head + cross-entropy over this many tokens at a time, the full (B, T, vocab_size) logits, the largest
+# single activation of a step, are never built. 0 materializes them
+loss_chunk_size = 4096
+
 # Batch parameters
 total_batch_size = 2**19  # ~0.5M tokens
 B = 16  # Micro batch size
@@ -54,16 +71,25 @@ if master_process:
     print(f"total desired batch size: {total_batch_size}")
     print(f"=> calculated gradient accumulation steps: {grad_accum_steps}")
 
-# Data loaders
-train_loader = DataLoader(B=B, T=T, split="train")
-val_loader = DataLoader(B=B, T=T, split="val")
+# Data loaders, batches are prepared on a background thread (in pinned memory on CUDA) ahead of use
+pin_memory = device_type == "cuda"
+# every rank reads its own interleaved slices, set shuffle_shards to reorder train shards each epoch
+shuffle_shards = False
+train_loader = DataLoader(B=B, T=T, split="train", process_rank=ddp_rank, num_processes=ddp_world_size, shuffle=shuffle_shards, seed=1337, prefetch=4, pin_memory=pin_memory)
+val_loader = DataLoader(B=B, T=T, split="val", process_rank=ddp_rank, num_processes=ddp_world_size, prefetch=2, pin_memory=pin_memory)
 
 # Model setup
-model = GPT(GPTConfig(vocab_size=50304), use_lora=False)
+# grouped-query attention: n_kv_head key/value heads, each shared by n_head // n_kv_head query heads (None = one per head)
+n_kv_head = None
+model = GPT(GPTConfig(vocab_size=50304, n_kv_head=n_kv_head, checkpoint_activations=checkpoint_activations, checkpoint_every=checkpoint_every, loss_chunk_size=loss_chunk_size), use_lora=False)
 model.to(device)
+raw_model = model
+# opt-in torch.compile, training and val batches are always (B, T) so it compiles once per mode
+use_compile = False
+if use_compile:
+    model = CompiledGPT(raw_model).forward
 if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank])
-raw_model = model.module if ddp else model 
+    model = DDP(model, device_ids=[ddp_local_rank] if device_type == "cuda" else None)
 
 # Learning rate scheduler
 def get_lr(it):
@@ -75,34 +101,64 @@ def get_lr(it):
     coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio))
     return min_lr + coeff * (max_lr - min_lr)
     
-optimizer = raw_model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4)
+# ZeRO stage 1: shard the AdamW state across DDP ranks, checkpoints then hold one optimizer file per rank
+zero_optimizer = False
+use_zero = ddp and zero_optimizer
+optimizer = raw_model.configure_optimizers(weight_decay=0.1, learning_rate=6e-4, zero=use_zero)
 
 # Create log directory
 log_dir = "log"
 os.makedirs(log_dir, exist_ok=True)
 log_file = os.path.join(log_dir, "log.txt")
 
+# Checkpoints are written by rank 0 only, on a background thread, and renamed into place once complete.
+# Numbered model checkpoints: the newest keep_last are kept, plus every multiple of keep_every steps
+checkpoint_manager = CheckpointManager(log_dir, is_writer=master_process, rank=ddp_rank, keep_last=4, keep_every=20000)
+
+# Weights to start from when there is nothing to resume, e.g. a checkpoint converted by convert_gqa.py for uptraining
+init_from = None
+
 # Load checkpoint if available
 start_step = 0
-checkpoint_path = os.path.join(log_dir, "latest_checkpoint.pt")
 append_mode = False
-if os.path.exists(checkpoint_path):
-    checkpoint = torch.load(checkpoint_path, map_location=device)
-    model.load_state_dict(checkpoint['model'])
-    optimizer.load_state_dict(checkpoint['optimizer'])
+checkpoint = checkpoint_manager.load_latest(map_location=device)
+if checkpoint is not None:
+    raw_model.load_state_dict(checkpoint['model'])
+    if use_zero:
+        assert checkpoint.get('zero_world_size') == ddp_world_size, "the optimizer state was not sharded over this many ranks"
+        optimizer.optim.load_state_dict(checkpoint_manager.load_shard(checkpoint['step'], map_location=device))
+    else:
+        assert checkpoint.get('optimizer') is not None, "the checkpoint only has sharded optimizer state, resume with ZeRO on the same world size"
+        optimizer.load_state_dict(checkpoint['optimizer'])
     start_step = checkpoint['step']
-    train_loader.current_shard = checkpoint['current_shard']
-    train_loader.current_position = checkpoint['current_position']
-    print(f"Resuming training from step {start_step}, shard: {checkpoint['current_shard']}")
+    if 'train_loader' in checkpoint:
+        train_loader.load_state_dict(checkpoint['train_loader'])
+    else:
+        # older checkpoints only stored the shard and position of a single process
+        train_loader.set_state(checkpoint['current_shard'], checkpoint['current_position'])
+    print(f"Resuming training from step {start_step}, shard: {train_loader.current_shard}")
     append_mode = True
+elif init_from is not None:
+    raw_model.load_state_dict(torch.load(init_from, map_location=device)['model'])
+    print(f"Starting from the weights of {init_from}")
 
 # Logging setup
 with open(log_file, "a" if append_mode else "w"):
     pass
 
+# Instrumentation: per-phase step times, MFU and structured metrics in log/metrics.jsonl.
+# sync_phases synchronizes CUDA at every phase boundary so the time lands in the phase that did the work,
+# it stalls the non-blocking host to device copies and lowers tok/sec, so only turn it on to profile
+sync_phases = False
+peak_flops = 312e12 if device_type == "cuda" else None  # per device, A100 bf16; set it for your hardware, None skips MFU
+profile_steps = None  # e.g. (10, 13) captures a torch.profiler trace of steps 10-12
+metrics = MetricsLogger(os.path.join(log_dir, "metrics.jsonl"), enabled=master_process, append=append_mode)
+timer = StepTimer(sync=sync_phases)
+profiler = StepProfiler(*profile_steps, os.path.join(log_dir, f"trace_rank{ddp_rank}.json"), device_type) if profile_steps else None
+model_flops_per_token = flops_per_token(raw_model.config, T)
+
 # Training loop
 for step in range(start_step, max_steps):
-    t0 = time.time()
     last_step = (step == max_steps - 1)
 
     # Validation
@@ -114,7 +170,7 @@ for step in range(start_step, max_steps):
         with torch.no_grad():
             for _ in range(val_loss_steps):
                 x, y = val_loader.next_batch()
-                x, y = x.to(device), y.to(device)
+                x, y = x.to(device, non_blocking=pin_memory), y.to(device, non_blocking=pin_memory)
                 with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
                     _, loss = model(x, y)
                 val_loss_accum += loss / val_loss_steps
@@ -126,56 +182,104 @@ for step in range(start_step, max_steps):
             print(f"Validation loss: {val_loss:.4f}")
             with open(log_file, "a") as f:
                 f.write(f"step: {step} | val: {val_loss:.4f}\n")
+            metrics.log(kind="val", step=step, loss=val_loss)
 
-        # Save checkpoint
+        # Save checkpoint, this only blocks for the in-memory snapshot
         checkpoint = {
-            'model': model.state_dict(),
+            'model': raw_model.state_dict(),
             'step': step,
             'val_loss': val_loss_accum.item(),
-            'optimizer': optimizer.state_dict(),
-            'current_shard': train_loader.current_shard,
-            'current_position': train_loader.current_position
+            'optimizer': None if use_zero else optimizer.state_dict(),
+            'zero_world_size': ddp_world_size if use_zero else None,
+            'train_loader': train_loader.state_dict()
         }
-        torch.save(checkpoint, checkpoint_path)
-        if step % 5000 == 0 or last_step:
-            torch.save({'model': model.state_dict()}, os.path.join(log_dir, f"arcane_{step}.pt"))
+        # with ZeRO every rank saves the optimizer state of its own parameters
+        shard = optimizer.optim.state_dict() if use_zero else None
+        checkpoint_manager.save(checkpoint, step, numbered=step % 5000 == 0 or last_step, shard=shard)
+        if master_process:
+            print(f"checkpoint snapshot: {checkpoint_manager.snapshot_time * 1000:.0f}ms")
+
+    # HellaSwag eval, every rank scores its share of the examples and the counts are all-reduced
+    if step % 250 == 0 or last_step:
+        num_correct_norm, _, num_total = evaluate_batched(raw_model, device, process_rank=ddp_rank, num_processes=ddp_world_size)
+        if master_process:
+            acc_norm = num_correct_norm / num_total
+            print(f"HellaSwag accuracy: {num_correct_norm}/{num_total}={acc_norm:.4f}")
+            with open(log_file, "a") as f:
+                f.write(f"step: {step} | hella: {acc_norm:.4f}\n")
+            metrics.log(kind="hellaswag", step=step, acc_norm=acc_norm)
 
     # Training
+    if profiler is not None:
+        profiler.step_begin(step)
+    if device_type == "cuda":
+        torch.cuda.synchronize()  # start the step clock once the evaluation above has finished on the device
+    t0 = time.time()
     model.train()
     optimizer.zero_grad(set_to_none=True)
     loss_accum = 0.0
+    train_loader.wait_time = 0.0
+    timer.reset()
 
     # Gradient accumulation
     for micro_step in range(grad_accum_steps):
-        x, y = train_loader.next_batch()
-        x, y = x.to(device), y.to(device)
+        with timer.phase("data"):
+            x, y = train_loader.next_batch()
+            x, y = x.to(device, non_blocking=pin_memory), y.to(device, non_blocking=pin_memory)
         if ddp:
             model.require_backward_grad_sync = (micro_step == grad_accum_steps - 1)
-        with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-            _, loss = model(x, y)
-        loss = loss / grad_accum_steps
-        loss_accum += loss
-        loss.backward()
-    if ddp:
-        dist.all_reduce(loss_accum, op=dist.ReduceOp.AVG)
-    torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+        with timer.phase("forward"):
+            with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
+                _, loss = model(x, y)
+            loss = loss / grad_accum_steps
+            loss_accum += loss.detach()
+        with timer.phase("backward"):
+            loss.backward()
+    with timer.phase("loss_allreduce"):
+        if ddp:
+            dist.all_reduce(loss_accum, op=dist.ReduceOp.AVG)
+    with timer.phase("clip"):
+        norm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
 
     # Set learning rate and update optimizer
-    for param_group in optimizer.param_groups:
-        param_group['lr'] = get_lr(step)
-    optimizer.step()
+    with timer.phase("optimizer"):
+        lr = get_lr(step)
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = lr
+        optimizer.step()
+    if step == start_step and master_process:
+        state = (optimizer.optim if use_zero else optimizer).state.values()
+        state_bytes = sum(t.numel() * t.element_size() for s in state for t in s.values() if torch.is_tensor(t))
+        print(f"optimizer state on rank 0: {state_bytes / 2**20:.1f} MiB")
 
-    torch.cuda.synchronize()
+    if device_type == "cuda":
+        torch.cuda.synchronize()
+    if profiler is not None:
+        profiler.step_end(step)
 
     # Logging
     t1 = time.time()
     dt = t1 - t0 # time difference in seconds
     tokens_processed = train_loader.B * train_loader.T * grad_accum_steps * ddp_world_size
     tokens_per_sec = tokens_processed / dt
+    data_wait = train_loader.wait_time # time this step spent waiting on the input pipeline
+    # DDP all-reduces gradients inside the last micro step's backward, where it cannot be timed on its own;
+    # grad_sync_est is an estimate: how much longer that backward took than the mean of the others
+    backward = timer.samples["backward"]
+    grad_sync_est = max(0.0, backward[-1] - sum(backward[:-1]) / (len(backward) - 1)) if ddp and len(backward) > 1 else 0.0
+    phases = {name: timer.total(name) for name in ("data", "forward", "backward", "loss_allreduce", "clip", "optimizer")}
+    phases["backward"] -= grad_sync_est
+    phases["grad_sync_est"] = grad_sync_est
+    mfu = model_flops_per_token * tokens_per_sec / (peak_flops * ddp_world_size) if peak_flops else None
     if master_process:
-        print(f"step {step:5d} | loss: {loss_accum.item():.6f} | dt: {dt*1000:.2f}ms | tok/sec: {tokens_per_sec:.2f}")
+        phase_str = " ".join(f"{name} {t*1000:.0f}" for name, t in phases.items())
+        mfu_str = f" | mfu: {mfu*100:.1f}%" if mfu is not None else ""
+        print(f"step {step:5d} | loss: {loss_accum.item():.6f} | dt: {dt*1000:.2f}ms | data: {data_wait*1000:.2f}ms | tok/sec: {tokens_per_sec:.2f}{mfu_str} | ms: {phase_str}")
         with open(log_file, "a") as f:
-            f.write(f"{step} train {loss_accum.item():.6f} | dt: {dt*1000:.2f}ms | tok/sec: {tokens_per_sec:.2f}\n")
+            f.write(f"{step} train {loss_accum.item():.6f} | dt: {dt*1000:.2f}ms | data: {data_wait*1000:.2f}ms | tok/sec: {tokens_per_sec:.2f}\n")
+        metrics.log(kind="train", step=step, loss=loss_accum.item(), lr=lr, grad_norm=norm.item(), dt=dt, data_wait=data_wait,
+                    tokens_per_sec=tokens_per_sec, mfu=mfu, **{f"{name}_time": t for name, t in phases.items()})
 
+checkpoint_manager.wait()  # the last checkpoint may still be in flight
 if ddp:
     destroy_process_group()
\ No newline at end of file